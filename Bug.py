@@ -7,14 +7,43 @@ import BugWorld as bw
 import Collisions as coll
 import BugPopulation as pop
 import BugBrain as bb
+import BugState as bs
 
 logger = logging.getLogger()
 logger.setLevel(logging.ERROR)
 
 
-class BugEyeHitbox(bw.BWObject):
+class BugPart(bw.BWObject):
+	"""something mounted on a bug that doesn't move relative to it, e.g., an eye.  If the bug is in a BugState the
+		part gets a part slot and its abs position is worked out with everyone else's (see BugState.place)"""
+
+	__slots__ = ('_state', '_slot', 'owner')
+
+	abs_position = bs.StatePose('part_x', 'part_y', 'part_theta', 'part_mirror')
+
+	def __init__(self, bug_world, pos_transform, name):
+		self._state = None  # until the bug gives it a part slot
+		self._slot = None
+		super().__init__(bug_world, pos_transform, name)
+
+	def get_abs_x(self):
+		if self._state is None:
+			return super().get_abs_x()
+		return self._state.part_x[self._slot]
+
+	def get_abs_y(self):
+		if self._state is None:
+			return super().get_abs_y()
+		return self._state.part_y[self._slot]
+
+
+class BugEyeHitbox(BugPart):
 	"""This object is mounted on an eye so it can be offset and larger than the physical eye"""
 
+	__slots__ = ()
+
+	DETECTS = (coll.Collisions.VISUAL,)  # for rejoin
+
 	def __init__(self, bug_world, owner, pos_transform, size=15,name="EHB"):
 		self.name = name
 		# position should be center of eye + radius of hitbox
@@ -25,7 +54,7 @@ class BugEyeHitbox(bw.BWObject):
 		self.type = bw.BWOType.EHB
 		self.owner = owner
 		self.ci = coll.CollisionInterface(bug_world.collisions, owner)
-		self.ci.register_as_detector(self, coll.Collisions.VISUAL)
+		self.ci.register_as_detector(self, coll.Collisions.VISUAL)  # DETECTS, registered straight away even when spawning
 
 	def update(self, base):
 		# eyes don't move independent of bug, so relative pos won't change.
@@ -42,9 +71,13 @@ class BugEyeHitbox(bw.BWObject):
 		self.owner = None
 
 
-class BugEye(bw.BWObject):
+class BugEye(BugPart):
+
+	__slots__ = ()
 
-	def __init__(self, bug_world, owner, pos_transform, size=1, name="E"):
+	_hitbox_locations = {}  # hitbox size -> where the hitbox sits on the eye.  Shared by every eye of that size
+
+	def __init__(self, bug_world, owner, pos_transform, size=1, name="E", hitbox=True):
 		self.name = name
 		super().__init__(bug_world, pos_transform, name)
 		self.size = size
@@ -52,12 +85,19 @@ class BugEye(bw.BWObject):
 		self.default_color = self.color
 		self.type = bw.BWOType.EYE
 		self.owner = owner
-		self.HITBOX_SIZE = self.size * 5
 
 		# add the eye hitbox for the current eye
-		# put hitbox so tangent with eye center...actually add 1 so avoid collision with bug just for efficiency
-		self.HITBOX_LOC = bw.BugWorld.get_pos_transform((self.HITBOX_SIZE + 1), 0, 0, 0)
-		self.add_subcomponent(BugEyeHitbox(bug_world, owner, self.HITBOX_LOC, self.HITBOX_SIZE, name))
+		if hitbox:  # not needed if the world uses ray vision
+			hitbox_size = self.size * 5
+			self.add_subcomponent(BugEyeHitbox(bug_world, owner, self.hitbox_location(hitbox_size), hitbox_size, name))
+
+	@classmethod
+	def hitbox_location(cls, hitbox_size):
+		location = cls._hitbox_locations.get(hitbox_size)
+		if location is None:
+			# put hitbox so tangent with eye center...actually add 1 so avoid collision with bug just for efficiency
+			location = cls._hitbox_locations[hitbox_size] = bw.BugWorld.get_pos_transform((hitbox_size + 1), 0, 0, 0)
+		return location
 
 	def update(self, base):
 		# eyes don't move independent of bug, so relative pos won't change.
@@ -83,14 +123,36 @@ class Bug(bw.BWObject):
 	DEFAULT_TURN_AMT = np.deg2rad(30)  	# turns are in radians, used for random moving
 	DEFAULT_MOVE_AMT = 5				# used for random moving
 
+	EMITS = (coll.Collisions.PHYSICAL, coll.Collisions.VISUAL)  # can be hit, can be seen
+	DETECTS = (coll.Collisions.PHYSICAL,)  # can detect hitting something
+
+	# so there is no per bug __dict__.  The StateFields keep their value in the _ slots if there is no BugState
+	__slots__ = ('_state', '_slot', '_size', '_energy', '_health', '_score', '_vel_r', '_vel_l',
+				 'owner', 'pi', 'bi', '_parts')
+
+	# the same for every bug, so they aren't stored on each one
+	default_energy = 100
+	default_health = 100
+	default_score = 0
+	_eye_locations = {}  # bug size -> (right eye, left eye) poses, shared by every bug of that size
+
+	# kept in the world's BugState if it has one.  see BugState
+	rel_position = bs.StatePose('x', 'y', 'theta')
+	abs_position = bs.StatePose('abs_x', 'abs_y', 'abs_theta', 'abs_mirror')
+	size = bs.StateField()
+	energy = bs.StateField()
+	health = bs.StateField(on_change='health_changed')
+	score = bs.StateField()
+	vel_r = bs.StateField()
+	vel_l = bs.StateField()
+
 	def __init__(self, bug_world, initial_pos, name="Bug", genome=None, bug_type=None):
+		self._state = bug_world.bug_state
+		self._slot = self._state.add() if self._state is not None else None
 		super().__init__(bug_world, initial_pos, name)
 		self.size = 10  # override default and set the intial radius of bug
 		self.color = bw.Color.PINK  # override default and set the initial color of a default bug
 		self.default_color = self.color
-		self.default_energy = 100
-		self.default_health = 100
-		self.default_score = 0
 		self.energy = self.default_energy  # default...needs to be overridden
 		self.health = self.default_health
 		self.score = self.default_score  # used to reinforce behaviour.  Add to the score when does a "good" thing
@@ -104,9 +166,7 @@ class Bug(bw.BWObject):
 
 		# participate in the collision system
 		self.ci = coll.CollisionInterface(bug_world.collisions, self.owner)
-		self.ci.register_as_emitter(self, coll.Collisions.PHYSICAL)  	# can be hit
-		self.ci.register_as_detector(self, coll.Collisions.PHYSICAL) 	# can detect hitting something
-		self.ci.register_as_emitter(self, coll.Collisions.VISUAL)		# can be seen
+		self.register_collisions()
 
 		# participate in the population system.
 		self.pi = pop.BugPopulationInterface(bug_world, self, genome)  # uses bug_type
@@ -118,19 +178,49 @@ class Bug(bw.BWObject):
 		self.bi = bb.BugBrainInterface(self, config, genome)
 
 		# add the eyes for a default bug
-		# put eye center on circumference of bug body, rotate then translate.
-		rT = bw.BugWorld.get_pos_transform(0, 0, 0, np.deg2rad(-30))
-		tT = bw.BugWorld.get_pos_transform(self.size, 0, 0, 0)
-		self.RIGHT_EYE_LOC = np.matmul(rT, tT)
-
-		rT = bw.BugWorld.get_pos_transform(0, 0, 0, np.deg2rad(30))
-		self.LEFT_EYE_LOC = np.matmul(rT, tT)
-
-		self.EYE_SIZE = int(self.size * 0.50)  # set a percentage the size of the bug
-
-		# instantiate the eyes
-		self.add_subcomponent(BugEye(bug_world, self.owner, self.RIGHT_EYE_LOC, self.EYE_SIZE,"R"))
-		self.add_subcomponent(BugEye(bug_world, self.owner, self.LEFT_EYE_LOC, self.EYE_SIZE,"L"))
+		right_eye_loc, left_eye_loc = self.eye_locations(self.size)
+		eye_size = int(self.size * 0.50)  # set a percentage the size of the bug
+
+		# instantiate the eyes.  With ray vision they are just for show
+		hitbox = not bw.BugWorld.RAY_VISION
+		self.add_subcomponent(BugEye(bug_world, self.owner, right_eye_loc, eye_size, "R", hitbox))
+		self.add_subcomponent(BugEye(bug_world, self.owner, left_eye_loc, eye_size, "L", hitbox))
+
+		self._parts = []
+		if self._state is not None:
+			self.add_parts(self._subcomponents, bw.BugWorld.IDENTITY)
+			if not bug_world.spawning:  # spawn places the whole batch
+				self._state.place(np.array([self._slot]), self._base)  # so it's in the right place before it moves
+
+	@classmethod
+	def eye_locations(cls, size):
+		"""(right, left) eye poses for a bug of this size.  Don't change them, other bugs have the same ones"""
+		locations = cls._eye_locations.get(size)
+		if locations is None:
+			# put eye center on circumference of bug body, rotate then translate.
+			tT = bw.BugWorld.get_pos_transform(size, 0, 0, 0)
+			right = bw.BugWorld.get_pos_transform(0, 0, 0, np.deg2rad(-30)).compose(tT)
+			left = bw.BugWorld.get_pos_transform(0, 0, 0, np.deg2rad(30)).compose(tT)
+			locations = cls._eye_locations[size] = (right, left)
+		return locations
+
+	def add_parts(self, subcomponents, offset):
+		"""gives each subcomponent, and theirs, a part slot with its fixed offset from the bug"""
+		for sc in subcomponents:
+			sc_offset = offset.compose(sc.get_rel_position())
+			self._state.add_part(self, sc, sc_offset)
+			self._parts.append(sc)
+			self.add_parts(sc._subcomponents, sc_offset)
+
+	def get_abs_x(self):
+		if self._state is None:
+			return super().get_abs_x()
+		return self._state.abs_x[self._slot]
+
+	def get_abs_y(self):
+		if self._state is None:
+			return super().get_abs_y()
+		return self._state.abs_y[self._slot]
 
 	def calc_fitness(self):
 		default_fitness = self.energy*self.health*self.score
@@ -141,16 +231,17 @@ class Bug(bw.BWObject):
 		self.score = self.default_score
 		self.health = self.default_health
 
-	def update(self, base):
+	def update(self, base, think=True):
+		"""think: False to keep the wheel velocities from the last time the brain ran (see BugWorld.Scheduler)"""
 		# uncomment this to not use the brain
 		# self.kinematic_wander()
 
-		# TODO implement the brain interface to control motion here
-		# update the brain with the velocity from the last cycle
-		self.bi.update_brain_inputs({"vel_r":self.vel_r, "vel_l":self.vel_l})
+		if think:
+			# update the brain with the velocity from the last cycle
+			self.bi.set_wheel_inputs(self.vel_r, self.vel_l)
 
-		# call the brain to update the velocities
-		self.vel_r, self.vel_l = self.bi.activate()
+			# call the brain to update the velocities
+			self.vel_r, self.vel_l = self.bi.activate()
 
 		#  use the velocities and the kinematic model to move the bug
 		delta_x, delta_y, delta_theta = self.kinematic_move(self.vel_r, self.vel_l)  # assume bugbot with two wheels
@@ -168,6 +259,53 @@ class Bug(bw.BWObject):
 		amt = abs(dist_moved)+abs(delta_theta)  # it costs energy to move or rotate
 		self.update_energy(amt)
 
+	@staticmethod
+	def update_all(bugs, base, think=True):
+		"""same as calling update(base, think) on each bug.  Bugs in a BugState that don't override the kinematics are
+			moved together and, unless they override update_score or update_energy, scored together too"""
+		batch = []
+		for bug in bugs:
+			if bug._state is not None and type(bug).update is Bug.update and type(bug).kinematic_move is Bug.kinematic_move:
+				batch.append(bug)
+			else:
+				bug.update(base, think)
+		if not batch:
+			return
+
+		state = batch[0]._state  # all of the bugs in a world share it
+		slots = np.array([bug._slot for bug in batch])
+
+		if think:  # otherwise they keep going with the wheel velocities they have
+			by_population = {}
+			for bug in batch:
+				bug.bi.set_wheel_inputs(bug.vel_r, bug.vel_l)
+				if bw.BugWorld.BATCH_BRAINS and bug.bi.compiled is not None:
+					by_population.setdefault(bug.pi.get_population(), []).append(bug)
+				else:  # its genome doesn't fit the population's layers
+					bug.vel_r, bug.vel_l = bug.bi.activate()
+			for population, same_population in by_population.items():
+				actions = population.brains.activate([bug.bi for bug in same_population])
+				brain_slots = np.array([bug._slot for bug in same_population])
+				state.vel_r[brain_slots] = actions[:, 0]
+				state.vel_l[brain_slots] = actions[:, 1]
+
+		size = state.size[slots]
+		delta_x, delta_y, delta_theta = state.kinematic_move(slots, size * 0.5, size * 2)  # same as kinematic_move
+		dist_moved = delta_x + delta_y
+		amt = np.abs(dist_moved) + np.abs(delta_theta)
+
+		state.place(slots, base)  # the bugs and all of their parts
+
+		default_score = np.array([type(bug).update_score is Bug.update_score for bug in batch])
+		default_energy = np.array([type(bug).update_energy is Bug.update_energy for bug in batch])
+		state.score[slots[default_score]] += dist_moved[default_score]
+		state.energy[slots[default_energy]] -= amt[default_energy]
+		for n in np.flatnonzero(~(default_score & default_energy)).tolist():
+			if not default_score[n]:
+				batch[n].update_score(dist_moved[n])
+			if not default_energy[n]:
+				batch[n].update_energy(amt[n])
+
 	def update_score(self, dist_moved):
 		"""override this method to change how a bug's score is calculated"""
 		self.score += dist_moved
@@ -176,7 +314,40 @@ class Bug(bw.BWObject):
 		"""override this method to change how a bug's energy is calculated"""
 		self.energy -= dist_moved
 
+	def revive(self, initial_pos, name, genome=None):
+		"""puts a bug that was released back in the world as a new bug with the genome.  See EntityPool"""
+		bug_world = self.bug_world
+		self._state = bug_world.bug_state
+		self._slot = self._state.add() if self._state is not None else None
+		self.rel_position = initial_pos
+		self.name = name
+		self.size = 10
+		self.color = self.default_color
+		self.reset_fitness()
+		self.vel_r = 0
+		self.vel_l = 0
+
+		self.register_collisions()
+		for sc in self._subcomponents:
+			sc.rejoin()
+		self.pi.join(self, genome)
+		self.bi.create_brain(self.pi.get_population_config(), self.pi.get_genome())
+
+		self._parts.clear()
+		if self._state is not None:
+			self.add_parts(self._subcomponents, bw.BugWorld.IDENTITY)
+			if not bug_world.spawning:  # spawn places the whole batch
+				self._state.place(np.array([self._slot]), self._base)
+
+	def release(self):
+		if self._state is not None:
+			self._state.remove(self, self._parts)
+		super().release()
+		self.pi.deregister()
+
 	def kill(self):  # overridden to include bug specific stuff
+		if self._state is not None:
+			self._state.remove(self, self._parts)
 		super().kill()
 		self.ci.deregister_all()
 		self.ci = None
@@ -189,11 +360,11 @@ class Bug(bw.BWObject):
 	def move_forward(self, amount_to_move=DEFAULT_MOVE_AMT):
 		# assume bug's 'forward' is along the x direction in the bug's local coord frame
 		tM = bw.BugWorld.get_pos_transform(x=amount_to_move, y=0, z=0, theta=0)  # create an incremental translation
-		self.set_rel_position(np.matmul(self.rel_position, tM))  # update the new position
+		self.set_rel_position(self.rel_position.compose(tM))  # update the new position
 
 	def turn_left(self, theta=DEFAULT_TURN_AMT):
 		rM = bw.BugWorld.get_pos_transform(x=0, y=0, z=0, theta=theta)  # create an incremental rotation
-		self.set_rel_position(np.matmul(self.rel_position, rM))  # update the new position
+		self.set_rel_position(self.rel_position.compose(rM))  # update the new position
 
 	def turn_right(self, theta=DEFAULT_TURN_AMT):
 		# 'turning right is just a negative angle passed to turn left'
@@ -204,7 +375,7 @@ class Bug(bw.BWObject):
 		rand_x = random.randint(0, Bug.DEFAULT_MOVE_AMT)
 		rand_theta = random.uniform(-Bug.DEFAULT_TURN_AMT, Bug.DEFAULT_TURN_AMT)
 		wM = bw.BugWorld.get_pos_transform(x=rand_x, y=0, z=0, theta=rand_theta)  # create an incremental movement
-		self.set_rel_position(np.matmul(self.rel_position, wM))  # update the new relative position
+		self.set_rel_position(self.rel_position.compose(wM))  # update the new relative position
 
 	def kinematic_wander(self):
 		rand_vr = random.uniform(-.5, 1)  # random right wheel velocity normalized
@@ -213,7 +384,7 @@ class Bug(bw.BWObject):
 
 		delta_x, delta_y, delta_theta = self.kinematic_move(rand_vr, rand_vl)
 		wM = bw.BugWorld.get_pos_transform(x=delta_x, y=delta_y, z=0, theta=delta_theta)  # create an incremental movement
-		self.set_rel_position(np.matmul(self.rel_position, wM))  # update the new relative position
+		self.set_rel_position(self.rel_position.compose(wM))  # update the new relative position
 
 	def kinematic_move(self, vel_r, vel_l):  # assume bugbot with two wheels on each side of it.
 		# taken from GRIT robotics course
@@ -224,7 +395,7 @@ class Bug(bw.BWObject):
 		delta_x = temp_vect * np.cos(delta_theta)
 		delta_y = temp_vect * np.sin(delta_theta)
 		wM = bw.BugWorld.get_pos_transform(x=delta_x, y=delta_y, z=0, theta=delta_theta)  # create an incremental movement
-		self.set_rel_position(np.matmul(self.rel_position, wM))  # update the new relative position
+		self.set_rel_position(self.rel_position.compose(wM))  # update the new relative position
 		return delta_x, delta_y, delta_theta
 
 
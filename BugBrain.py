@@ -1,5 +1,7 @@
 
 import logging
+from collections import OrderedDict
+from configparser import ConfigParser
 import neat as NEAT
 import numpy as np
 
@@ -25,13 +27,96 @@ BugBrainInterface -- a bug must implement this interface to have a brain
 '''
 
 
+NETWORK_TYPES = {'feed_forward': NEAT.nn.FeedForwardNetwork, 'recurrent': NEAT.nn.RecurrentNetwork, 'ctrnn': NEAT.ctrnn.CTRNN}
+
+
+def load_config(config_path):
+	"""returns the NEAT config from the file with network_type and time_step from its [BugBrain] section added.
+		time_step is how much time a ctrnn brain is advanced each step of the world"""
+	config = NEAT.Config(NEAT.DefaultGenome, NEAT.DefaultReproduction, NEAT.DefaultSpeciesSet,
+						 NEAT.DefaultStagnation, config_path)
+	parameters = ConfigParser()
+	parameters.read(config_path)
+	config.network_type = parameters.get('BugBrain', 'network_type', fallback='feed_forward')
+	config.time_step = parameters.getfloat('BugBrain', 'time_step', fallback=1.0)
+	if config.network_type not in NETWORK_TYPES:
+		logging.error("unknown network_type: " + config.network_type + " using feed_forward")
+		config.network_type = 'feed_forward'
+	return config
+
+
+def network_type(config):
+	return getattr(config, 'network_type', 'feed_forward')  # a config that didn't come from load_config
+
+
+class BrainCache:
+	"""least recently used cache of the brains made from genomes, so a genome that comes back (e.g., a bug that is
+		revived with the same genome) doesn't build its net again.  Keyed by the config, the genome key and a hash of
+		the genome's contents so a genome that was changed in place is built again"""
+
+	def __init__(self, max_size=256):
+		self.max_size = max_size
+		self._brains = OrderedDict()  # key -> (net, compiled), oldest first
+		self.hits = 0
+		self.misses = 0
+
+	@staticmethod
+	def genome_hash(genome):
+		nodes = tuple((key, node.bias, node.response, node.activation, node.aggregation)
+			for key, node in sorted(genome.nodes.items()))
+		connections = tuple((key, cg.weight, cg.enabled) for key, cg in sorted(genome.connections.items()))
+		return hash((nodes, connections))
+
+	def get(self, genome, config):
+		"""returns (FeedForwardNetwork, BrainBatch.compile) for the genome.  Recurrent nets remember the last step
+			so can't be shared, for those the net is None (see BugBrainInterface.create_brain)"""
+		key = (config, network_type(config), genome.key, self.genome_hash(genome))
+		brain = self._brains.get(key)
+		if brain is not None:
+			self.hits += 1
+			self._brains.move_to_end(key)
+			return brain
+
+		self.misses += 1
+		net = NEAT.nn.FeedForwardNetwork.create(genome, config) if network_type(config) == 'feed_forward' else None
+		brain = (net, BrainBatch.compile(genome, config))
+		self._brains[key] = brain
+		if len(self._brains) > self.max_size:
+			self._brains.popitem(last=False)
+		return brain
+
+	def clear(self):
+		self._brains.clear()
+
+	def __len__(self):
+		return len(self._brains)
+
+
 class BugBrainInterface:
 
+	NUM_OTHER_INPUTS = 8  # health, energy, 2 wheel velocities and 4 bias.  The rest of num_inputs is vision
+
+	# where each sensor writes in the inputs row.  vision is the first num_inputs - NUM_OTHER_INPUTS, the rest are
+	# counted from the end so they stay put whatever num_inputs is
+	HEALTH = -8
+	ENERGY = -7
+	RIGHT_WHEEL = -6
+	LEFT_WHEEL = -5
+	BIAS = slice(-4, None)
+
+	EYES = {'right_eye': 0, 'left_eye': 1}  # which 3 vision inputs each eye's RGB goes in
+
+	# one per bug, so keep it small
+	__slots__ = ('_owner', '_config', 'inputs', '_eye_dist', 'net', 'compiled', 'memory', '_num_vision_inputs')
+
+	cache = BrainCache()  # shared by all of the bugs.  The nets only hold values between activations, so can be shared
+
 	def __init__(self, owner, config, genome):
 		self._owner = owner
 
 		# assume that the inputs are set before activate
-		self._brain_data = {}
+		self.inputs = None
+		self._eye_dist = np.full(len(self.EYES), np.inf)  # how far away what each eye is showing is, to keep the closest
 
 		if genome:
 			#create a brain with a genome
@@ -47,7 +132,24 @@ class BugBrainInterface:
 		for genome_id, genome in genome_dict.items():
 			pass
 
-		self.net = NEAT.nn.feed_forward.FeedForwardNetwork.create(genome, config)
+		# the sensors write straight into the row the brain reads.  A reused interface gets a clean one
+		num_inputs = config.genome_config.num_inputs
+		if self.inputs is None or len(self.inputs) != num_inputs:
+			self.inputs = np.zeros(num_inputs, dtype=np.float32)
+		self._num_vision_inputs = num_inputs - self.NUM_OTHER_INPUTS
+		self.inputs.fill(0.0)
+		self.inputs[self.BIAS] = 1.0
+		self.clear_vision()
+
+		# compiled is None if it can't be run with the rest of the population
+		self._config = config
+		self.net, self.compiled = self.cache.get(genome, config)
+		self.memory = None
+		if network_type(config) != 'feed_forward':
+			if self.compiled is not None:
+				self.memory = np.zeros(len(self.compiled[2]))  # the value of every node from the last step
+			else:
+				self.net = NETWORK_TYPES[network_type(config)].create(genome, config)
 
 	def activate(self):
 		# normalize inputs
@@ -59,7 +161,16 @@ class BugBrainInterface:
 		inputs = self.get_scaled_state()
 	
 		# run the inputs the nets activation collect the outputs (i.e., action)
-		action = self.net.activate(inputs)
+		if self.memory is not None:  # compiled recurrent brain, the same as the batch does
+			time_step = self._config.time_step if network_type(self._config) == 'ctrnn' else None
+			action = BrainBatch.advance(self.compiled, inputs, self.memory, time_step)
+			action = action[:self._config.genome_config.num_outputs].tolist()
+		elif network_type(self._config) == 'ctrnn':
+			time_step = self._config.time_step
+			action = self.net.advance(inputs.tolist(), time_step, time_step)
+		else:
+			action = self.net.activate(inputs.tolist())
+		self.clear_inputs()
 
 		'''
 		Outputs Phase 1
@@ -69,42 +180,45 @@ class BugBrainInterface:
 		'''
 		return action
 
-	def update_brain_inputs(self, brain_data):
-		"""brain_data: dictionary of key value pairs. keys used:
-			right_eye = tuple(R,G,B), dist_sqrd
-			left_eye = tuple(R,G,B), dist_sqrd
-				dist_sqrd = distance that the eye detected the colors provided
-				(associated with the colors passed at same call)
-			vel_r = the velocity of the right wheel from the last time step
-			vel_l = the velocity of the right wheel from the last time step
-
-		"""
-		# update the local copy with any data passed in.
-		# TODO: this is redundant and ugly error-prone code.  fix it
-		# for the eyes, cache the closest object to center of eye hit box TODO:make this closest to the bug
-		if 'right_eye' in brain_data:  # see if we are working with the right eye data
-			if 'right_eye' in self._brain_data:  # see if there is already some data cached
-				(curr_r,curr_g,curr_b), curr_dist_sqrd = self._brain_data.get('right_eye')  # get cached data
-				(r, g, b), dist_sqrd = brain_data.get('right_eye')  # get the potential update
-				if dist_sqrd < curr_dist_sqrd:  # if the potential object is closer, use it, otherwise leave it alone
-					self._brain_data.update(brain_data)
-				return
-			else:
-				self._brain_data.update(brain_data)
-				return
-
-		if 'left_eye' in brain_data:  # see if we are working with the left eye data
-			if 'left_eye' in self._brain_data:  # see if there is already some data cached
-				(curr_r, curr_g, curr_b), curr_dist_sqrd = self._brain_data.get('left_eye')  # get cached data
-				(r, g, b), dist_sqrd = brain_data.get('left_eye')  # get the potential update
-				if dist_sqrd < curr_dist_sqrd:  # if the potential object is closer, use it, otherwise leave it alone
-					self._brain_data.update(brain_data) # only update the brain if it was closer
-				return
-			else:
-				self._brain_data.update(brain_data)
-				return
-
-		self._brain_data.update(brain_data)  # if not dealing with the eyes, just update the data
+	def set_wheel_inputs(self, vel_r, vel_l):
+		"""the velocities of the wheels from the last time step"""
+		inputs = self.inputs
+		inputs[self.RIGHT_WHEEL] = vel_r
+		inputs[self.LEFT_WHEEL] = vel_l
+
+	def update_eye_input(self, eye, color, dist_sqrd):
+		"""eye: 'right_eye' or 'left_eye'.  color: (R,G,B) the eye saw dist_sqrd away.  Only kept if it is closer
+			than anything else the eye saw this step"""
+		n = self.EYES[eye]
+		if dist_sqrd < self._eye_dist[n]:
+			self.set_eye_input(eye, color, dist_sqrd)
+
+	def set_eye_input(self, eye, color, dist_sqrd):
+		"""eye: 'right_eye' or 'left_eye'.  Overwrites whatever the eye saw; use when the caller already picked
+			the closest object, e.g., from a nearest query of the collision system"""
+		n = self.EYES[eye]
+		self._eye_dist[n] = dist_sqrd
+		if self._num_vision_inputs == 3 * len(self.EYES):  # otherwise the vision inputs are rays
+			r, g, b = color
+			self.inputs[3 * n:3 * n + 3] = (r / 100.0, g / 100.0, b / 100.0)
+
+	def set_vision(self, colors):
+		"""colors: (rays, 3) array of RGB the rays see.  From RayVision.  Used instead of the eye inputs, which only
+			give color too, so how far away things are is dropped.  num_inputs in the config must be
+			3 per ray + NUM_OTHER_INPUTS"""
+		self.inputs[:self._num_vision_inputs] = colors.ravel() / 100.0
+
+	def clear_inputs(self):
+		"""forget the inputs that are written every time the brain runs (health, energy and the wheels).  What the bug
+			saw is kept until the next time it looks (see clear_vision)"""
+		inputs = self.inputs
+		inputs[self.HEALTH] = inputs[self.ENERGY] = 0.0
+		inputs[self.RIGHT_WHEEL] = inputs[self.LEFT_WHEEL] = 0.0
+
+	def clear_vision(self):
+		"""forget what the bug saw, e.g., nothing seen is black.  Call before the bug looks again"""
+		self.inputs[:self._num_vision_inputs] = 0.0
+		self._eye_dist.fill(np.inf)
 
 	def scale_to_zero_to_one(self, x):
 		# sigmoid goes from [0,1]
@@ -124,34 +238,12 @@ class BugBrainInterface:
 			return x
 
 	def get_scaled_state(self):
-
-		# must match num_inputs from config file
+		"""returns the inputs row (not a copy) with health and energy filled in.  Must match num_inputs from config
+			file.  Call clear_inputs after it is used so the wheels etc. aren't used again if they aren't updated"""
 		# should scale from -1 to 1 or 0 to 1 to help the neural net stabilize and converge
-		inputs = []
-
-		(r, g, b), dist_sqrd = self._brain_data.get("right_eye", ((0, 0, 0), 0))
-		inputs.append(r/100.0)
-		inputs.append(g/100.0)
-		inputs.append(b/100.0)
-
-		(r, g, b), dist_sqrd = self._brain_data.get("left_eye", ((0, 0, 0), 0))
-		inputs.append(r/100.0)
-		inputs.append(g/100.0)
-		inputs.append(b/100.0)
-
-		inputs.append(self.cap_zero_to_one(self._owner.health/100.0))
-		inputs.append(self.cap_zero_to_one(self._owner.energy/100.0))
-
-		inputs.append(self._brain_data.get("right_wheel_v", 0))
-		inputs.append(self._brain_data.get("left_wheel_v", 0))
-
-		# bias neurons
-		inputs.extend([1, 1, 1, 1])
-
-		# remove all of the brain data in case it isn't updated on next iteration
-		self._brain_data.clear()
-
-		# return as inputs for the net
+		inputs = self.inputs
+		inputs[self.HEALTH] = self.cap_zero_to_one(self._owner.health/100.0)
+		inputs[self.ENERGY] = self.cap_zero_to_one(self._owner.energy/100.0)
 		return inputs
 
 	''' Inputs:
@@ -190,4 +282,332 @@ Phase 2
 - emit odor
 - communicate
 
-'''
\ No newline at end of file
+'''
+
+class BrainBatch:
+	"""runs the brains of many bugs at once.  Genomes from a config with no structural mutation all have the same
+		nodes, so their weights are stacked into arrays and every bug is evaluated with a matmul per layer instead of
+		walking the NEAT node lists.  Recurrent and ctrnn brains keep the value of every node from the last step in a
+		matrix with a row per bug and all of them are advanced together.  A genome that doesn't fit compiles to None
+		and its bug uses its own net.  There is one per BugPopulation"""
+
+	def __init__(self, config):
+		self._num_outputs = config.genome_config.num_outputs
+		self._network_type = network_type(config)
+		self._time_step = config.time_step if self._network_type == 'ctrnn' else None
+		self._compiled = []  # the compiled brains that were stacked, in order
+		self._stacked = None
+		self._inputs = None  # a row per bug. their interfaces' inputs are views of it so the sensors write straight in
+		self._memory = None  # same for what recurrent brains remember
+		self._rows = []  # the (inputs, memory) views, to check each interface still has its own rows
+		self.rebuilds = 0
+
+	@staticmethod
+	def compile(genome, config):
+		"""returns arrays that give the same outputs as the genome's NEAT network for the config's network_type, or
+			None if the genome has to use its own net"""
+		if network_type(config) == 'feed_forward':
+			return BrainBatch.compile_layers(genome, config)
+		return BrainBatch.compile_recurrent(genome, config)
+
+	@staticmethod
+	def compile_layers(genome, config):
+		"""returns (w1, b1, r1, w2, b2, r2) arrays that give the same outputs as the genome's FeedForwardNetwork, or
+			None if the genome isn't all tanh/sum nodes connected input -> hidden -> output with num_hidden hidden"""
+		genome_config = config.genome_config
+		inputs = {key: n for n, key in enumerate(genome_config.input_keys)}
+		outputs = {key: n for n, key in enumerate(genome_config.output_keys)}
+		hidden = {key: n for n, key in enumerate(sorted(key for key in genome.nodes if key not in outputs))}
+		if len(hidden) != genome_config.num_hidden or not BrainBatch.all_tanh_sum(genome):
+			return None
+
+		w1 = np.zeros((len(hidden), len(inputs)))
+		w2 = np.zeros((len(outputs), len(hidden)))
+		for cg in genome.connections.values():
+			if not cg.enabled:  # a disabled connection is the same as a weight of 0
+				continue
+			in_key, out_key = cg.key
+			if in_key in inputs and out_key in hidden:
+				w1[hidden[out_key], inputs[in_key]] = cg.weight
+			elif in_key in hidden and out_key in outputs:
+				w2[outputs[out_key], hidden[in_key]] = cg.weight
+			else:  # direct or recurrent connections need the per bug net
+				return None
+
+		hidden_nodes = [genome.nodes[key] for key in hidden]
+		output_nodes = [genome.nodes[key] for key in outputs]
+		b1 = np.array([node.bias for node in hidden_nodes])
+		r1 = np.array([node.response for node in hidden_nodes])
+		b2 = np.array([node.bias for node in output_nodes])
+		r2 = np.array([node.response for node in output_nodes])
+		return w1, b1, r1, w2, b2, r2
+
+	@staticmethod
+	def compile_recurrent(genome, config):
+		"""returns (w_in, w_nodes, bias, response, time_constant, evaluated) for every node, outputs first.  Any
+			connection between nodes is allowed.  evaluated is 0 for nodes NEAT never evaluates (no connections in),
+			they stay 0.  None if the genome isn't all tanh/sum nodes or doesn't have num_hidden hidden nodes"""
+		genome_config = config.genome_config
+		inputs = {key: n for n, key in enumerate(genome_config.input_keys)}
+		outputs = list(genome_config.output_keys)
+		keys = outputs + sorted(key for key in genome.nodes if key not in outputs)
+		nodes = {key: n for n, key in enumerate(keys)}
+		if len(nodes) != len(outputs) + genome_config.num_hidden or not BrainBatch.all_tanh_sum(genome):
+			return None
+
+		# the same connections as RecurrentNetwork.create and CTRNN.create use
+		required = NEAT.graphs.required_for_output(genome_config.input_keys, outputs, genome.connections)
+		w_in = np.zeros((len(nodes), len(inputs)))
+		w_nodes = np.zeros((len(nodes), len(nodes)))
+		evaluated = np.zeros(len(nodes))
+		for cg in genome.connections.values():
+			in_key, out_key = cg.key
+			if not cg.enabled or (in_key not in required and out_key not in required):
+				continue
+			if out_key not in nodes:
+				return None
+			evaluated[nodes[out_key]] = 1.0
+			if in_key in inputs:
+				w_in[nodes[out_key], inputs[in_key]] = cg.weight
+			else:
+				w_nodes[nodes[out_key], nodes[in_key]] = cg.weight
+
+		genes = [genome.nodes[key] for key in keys]
+		bias = np.array([node.bias for node in genes])
+		response = np.array([node.response for node in genes])
+		time_constant = np.array([node.time_constant for node in genes])
+		return w_in, w_nodes, bias, response, time_constant, evaluated
+
+	@staticmethod
+	def all_tanh_sum(genome):
+		return all(node.activation == 'tanh' and node.aggregation == 'sum' for node in genome.nodes.values())
+
+	def activate(self, interfaces):
+		"""same as calling activate on each interface.  returns a (len(interfaces), num_outputs) array of the actions.
+			All of them must have a compiled brain"""
+		if len(interfaces) != len(self._compiled) or any(
+				bi.compiled is not compiled or bi.inputs is not row or bi.memory is not memory
+				for bi, compiled, (row, memory) in zip(interfaces, self._compiled, self._rows)):
+			self.restack(interfaces)  # bugs were born or died
+
+		for bi in interfaces:
+			bi.get_scaled_state()  # fills in its row
+		inputs = self._inputs
+		if self._memory is None:
+			w1, b1, r1, w2, b2, r2 = self._stacked
+			hidden = self.tanh(b1 + r1 * np.einsum('nhi,ni->nh', w1, inputs))
+			actions = self.tanh(b2 + r2 * np.einsum('noh,nh->no', w2, hidden))
+		else:
+			memory = self.advance(self._stacked, inputs, self._memory, self._time_step)
+			actions = memory[:, :self._num_outputs].copy()  # the memory changes next step
+		for bi in interfaces:
+			bi.clear_inputs()
+		return actions
+
+	def restack(self, interfaces):
+		self._compiled = [bi.compiled for bi in interfaces]
+		self._stacked = [np.stack(arrays) for arrays in zip(*self._compiled)]
+		self._inputs = np.array([bi.inputs for bi in interfaces])  # keeps what the sensors wrote this step
+		if self._network_type == 'feed_forward':
+			self._memory = None
+			memories = [None] * len(interfaces)
+		else:
+			self._memory = np.array([bi.memory for bi in interfaces])  # and what each bug remembers
+			memories = list(self._memory)
+		self._rows = list(zip(self._inputs, memories))
+		for bi, (row, memory) in zip(interfaces, self._rows):
+			bi.inputs = row
+			bi.memory = memory
+		self.rebuilds += 1
+
+	@staticmethod
+	def advance(compiled, inputs, memory, time_step=None):
+		"""one step of recurrent brains from compile_recurrent, for one bug or stacked for many.  memory: the value of
+			every node from the last step, updated in place and returned.  time_step: None for recurrent, which uses
+			the new values as is.  For ctrnn, one Euler step of time_step towards them"""
+		w_in, w_nodes, bias, response, time_constant, evaluated = compiled
+		total = np.einsum('...ji,...i->...j', w_in, inputs) + np.einsum('...jk,...k->...j', w_nodes, memory)
+		values = BrainBatch.tanh(bias + response * total) * evaluated
+		if time_step is None:
+			memory[...] = values
+		else:
+			memory += (time_step / time_constant) * (values - memory)
+		return memory
+
+	@staticmethod
+	def tanh(z):
+		"""same as NEAT's tanh activation"""
+		return np.tanh(np.clip(2.5 * z, -60.0, 60.0))
+
+
+# --- Testing Code after this point ---
+
+def make_test_genomes(num):
+	"""returns the config from BUG-config-ff and a dictionary of num new genomes"""
+	import os
+	local_dir = os.path.dirname(os.path.abspath(__file__))
+	config = load_config(os.path.join(local_dir, 'BUG-config-ff'))
+	reporters = NEAT.reporting.ReporterSet()
+	reproduction = config.reproduction_type(config.reproduction_config, reporters,
+		config.stagnation_type(config.stagnation_config, reporters))
+	return config, reproduction.create_new(config.genome_type, config.genome_config, num)
+
+
+def test_brain_batch(num=20):
+	"""the batch must give the same actions as each bug's own net, and leave out genomes that don't fit"""
+	config, genomes = make_test_genomes(num + 1)
+	genome_config = config.genome_config
+
+	class TestBug:
+		health = 80
+		energy = 40
+
+	interfaces = []
+	for key, genome in list(genomes.items())[:num]:
+		genome.mutate(genome_config)  # some connections get disabled
+		interfaces.append(BugBrainInterface(TestBug(), config, {key: genome}))
+	assert all(bi.compiled is not None for bi in interfaces), "all of these have the same layers"
+
+	batch = BrainBatch(config)
+	def sense(bi, color, vel_r):
+		bi.clear_vision()
+		bi.update_eye_input('right_eye', color, 1.0)
+		bi.set_wheel_inputs(vel_r, -vel_r)
+
+	for step in range(3):
+		data = [(tuple(np.random.uniform(0, 100, 3)), np.random.uniform(-1, 1)) for bi in interfaces]
+		for bi, (color, vel_r) in zip(interfaces, data):
+			sense(bi, color, vel_r)
+		actions = batch.activate(interfaces)
+		for bi, (color, vel_r), action in zip(interfaces, data, actions):
+			assert not np.any(bi.inputs[-8:-4]), "health, energy and wheels should be cleared after the brain used them"
+			assert np.allclose(bi.inputs[:3], np.array(color) / 100.0), "what it saw should be kept"
+			sense(bi, color, vel_r)
+			assert np.allclose(bi.activate(), action), "batch doesn't match the bug's net"
+	assert batch.rebuilds == 1, "the same bugs shouldn't restack"
+
+	batch.activate(interfaces[1:])
+	assert batch.rebuilds == 2, "a bug left so it should restack"
+
+	# a direct connection doesn't fit the layers
+	genome = list(genomes.values())[num]
+	genome.add_connection(genome_config, genome_config.input_keys[0], genome_config.output_keys[0], 0.5, True)
+	assert BrainBatch.compile(genome, config) is None, "direct connection should use the per bug net"
+
+
+def test_recurrent_batch(num=10, steps=5):
+	"""recurrent brains in the batch must match NEAT's RecurrentNetwork step for step, including connections back
+		to themselves.  A ctrnn with time_step == time_constant is the same as recurrent"""
+	config, genomes = make_test_genomes(num + 1)
+	genome_config = config.genome_config
+	genomes = list(genomes.items())
+	for n, (key, genome) in enumerate(genomes):
+		genome.mutate(genome_config)
+		hidden = sorted(k for k in genome.nodes if k not in genome_config.output_keys)
+		genome.add_connection(genome_config, hidden[n % len(hidden)], hidden[(n + 1) % len(hidden)], 0.7, True)
+		genome.add_connection(genome_config, genome_config.output_keys[0], hidden[n % len(hidden)], -0.4, True)
+		genome.add_connection(genome_config, hidden[0], hidden[0], 0.3, True)
+
+	class TestBug:
+		health = 80
+		energy = 40
+
+	def run(interfaces, batch=None):
+		"""returns the actions each step and the inputs that made them"""
+		np.random.seed(7)
+		all_actions, all_inputs = [], []
+		for step in range(steps):
+			for bi in interfaces:
+				bi.clear_vision()
+				bi.update_eye_input('left_eye', tuple(np.random.uniform(0, 100, 3)), 1.0)
+				bi.set_wheel_inputs(np.random.uniform(-1, 1), np.random.uniform(-1, 1))
+			all_inputs.append([bi.get_scaled_state().tolist() for bi in interfaces])
+			if batch is not None:
+				all_actions.append(batch.activate(interfaces))
+			else:
+				all_actions.append([bi.activate() for bi in interfaces])
+		return np.array(all_actions), all_inputs
+
+	for network, time_step in (('recurrent', None), ('ctrnn', 1.0)):
+		config.network_type, config.time_step = network, time_step
+		interfaces = [BugBrainInterface(TestBug(), config, dict([item])) for item in genomes[:num]]
+		assert all(bi.compiled is not None for bi in interfaces), "recurrent connections are fine"
+		actions, inputs = run(interfaces, BrainBatch(config))
+
+		nets = [NEAT.nn.RecurrentNetwork.create(genome, config) for key, genome in genomes[:num]]
+		for step in range(steps):
+			expected = [net.activate(bug_inputs) for net, bug_inputs in zip(nets, inputs[step])]
+			assert np.allclose(actions[step], expected, atol=1e-6), network + " batch doesn't match RecurrentNetwork"
+
+	# a smaller time step only moves part way, the same with or without the batch
+	config.network_type, config.time_step = 'ctrnn', 0.5
+	batched, inputs = run([BugBrainInterface(TestBug(), config, dict([item])) for item in genomes[:num]],
+		BrainBatch(config))
+	one_at_a_time, inputs = run([BugBrainInterface(TestBug(), config, dict([item])) for item in genomes[:num]])
+	assert np.allclose(batched, one_at_a_time), "ctrnn batch doesn't match one bug at a time"
+
+	# an extra node doesn't fit, so the bug gets its own NEAT net
+	key, genome = genomes[num]
+	genome.nodes[max(genome.nodes) + 1] = genome.create_node(genome_config, max(genome.nodes) + 1)
+	bi = BugBrainInterface(TestBug(), config, {key: genome})
+	assert bi.compiled is None and isinstance(bi.net, NEAT.ctrnn.CTRNN), "should fall back to the NEAT net"
+	assert len(bi.activate()) == genome_config.num_outputs
+
+
+def test_brain_cache():
+	"""a genome is only built once unless it changes or falls out of the cache"""
+	import timeit
+	config, genomes = make_test_genomes(3)
+	a, b, c = genomes.values()
+	cache = BrainCache(max_size=2)
+
+	net, compiled = cache.get(a, config)
+	assert cache.get(a, config) == (net, compiled) and (cache.hits, cache.misses) == (1, 1), "second get should hit"
+
+	next(iter(a.connections.values())).weight += 0.1  # changed in place, so the old brain is wrong
+	assert cache.get(a, config)[0] is not net and cache.misses == 2, "changed genome should be built again"
+
+	cache.get(b, config)
+	cache.get(c, config)  # pushes out a, the least recently used
+	assert len(cache) == 2, "cache should stay at max_size"
+	misses = cache.misses
+	cache.get(b, config)
+	cache.get(a, config)
+	assert cache.misses == misses + 1, "b should still be cached, a should have been evicted"
+
+	build_time = timeit.timeit(lambda: (NEAT.nn.feed_forward.FeedForwardNetwork.create(a, config),
+		BrainBatch.compile(a, config)), number=50) / 50
+	hit_time = timeit.timeit(lambda: cache.get(a, config), number=50) / 50
+	print("brain build {:.2f}ms, cache hit {:.3f}ms".format(build_time * 1000, hit_time * 1000))
+
+
+def test_sensor_inputs():
+	"""each sensor writes its own slots in the row, and the eyes keep the closest thing they saw"""
+	config, genomes = make_test_genomes(1)
+
+	class TestBug:
+		health = 150
+		energy = 40
+
+	bi = BugBrainInterface(TestBug(), config, genomes)
+	bi.update_eye_input('right_eye', (100, 50, 0), 20.0)
+	bi.update_eye_input('right_eye', (0, 0, 100), 30.0)  # farther away so ignored
+	bi.update_eye_input('left_eye', (0, 0, 100), 30.0)
+	bi.set_wheel_inputs(0.5, -0.25)
+	expected = [1, 0.5, 0, 0, 0, 1, 1, 0.4, 0.5, -0.25, 1, 1, 1, 1]  # 6 eye, health capped, energy, 2 wheels, bias
+	assert np.allclose(bi.get_scaled_state(), expected), "inputs are in the wrong slots"
+	bi.clear_inputs()
+	assert np.allclose(bi.inputs, expected[:6] + [0] * 4 + [1] * 4), "what it saw should be kept for the next step"
+	bi.update_eye_input('left_eye', (100, 100, 100), 40.0)
+	assert bi.inputs[3] == 0, "farther than what the eye already saw"
+	bi.clear_vision()
+	assert np.allclose(bi.inputs, [0] * 10 + [1] * 4), "only the bias should be left"
+	bi.update_eye_input('left_eye', (100, 100, 100), 40.0)
+	assert bi.inputs[3] == 1, "a new look shouldn't compare with the old one"
+
+
+if __name__ == "__main__":
+	test_brain_batch()
+	test_sensor_inputs()
+	test_recurrent_batch()
+	test_brain_cache()
@@ -2,6 +2,7 @@
 import os
 import logging
 import math
+from itertools import count
 import neat as NEAT
 from neat.math_util import mean
 from neat.reporting import ReporterSet
@@ -10,6 +11,7 @@ from neat.reporting import ReporterSet
 #from memory_profiler import profile
 
 import BugWorld as bw
+import BugBrain as bb
 '''
 This is to encapsulate the population interface.
 
@@ -65,17 +67,29 @@ class BugPopulationInterface:
 		This will control what population the bug is part of and will register, deregister with the appropriate
 		population"""
 
+	__slots__ = ('_bug_world', '_owner_bug', '_genome', '_pop', '_pop_handle')  # one per bug, so keep it small
+
 	def __init__(self, bug_world, owner_bug, genome=None):
 		"""	bug_world: is where bug lives \
 			owner_bug: is the bug that owns this interface"""
 
 		self._bug_world = bug_world
+		self.join(owner_bug, genome)
+
+	def join(self, owner_bug, genome=None):
+		"""registers the bug with the population for its type.  Also used to bring back a bug that was deregistered"""
 		self._owner_bug = owner_bug
 		self._genome = genome
+		bug_world = self._bug_world
 
 		# populations will use the owner_bug.type to try to add it to the correct population
 		# assumes the populations interface has been already created on the World
-		self._pop = bug_world.populations.register(owner_bug)  # save the population  to make it easier later
+		# save the population to make it easier later, and the handle needed to leave it
+		# if the world is spawning a batch, it registers them all at once when they are built
+		if bug_world.spawning:
+			self._pop, self._pop_handle = bug_world.populations.lookup_population(owner_bug.type), None
+		else:
+			self._pop, self._pop_handle = bug_world.populations.register(owner_bug)
 
 		if self._genome is None:
 			self._genome = self._pop.get_new_genome()  	# genomes are specific to a given population.
@@ -109,14 +123,21 @@ class BugPopulationInterface:
 		# it is stored on the genome in the NEAT api
 		return self._owner_bug.calc_fitness()
 
+	def set_population_handle(self, handle):
+		"""used by BugPopulations.register_all"""
+		self._pop_handle = handle
+
 	def get_population_config(self):  # will be used so NEAT config items can be used to create brains
 		return self._pop.get_config()
 
+	def get_population(self):
+		return self._pop
+
 	# populations will use the owner_bug.type to try to remove it from the population.  it does not delete the bug
 	def deregister(self):
 		pop = self._pop
 		self._pop = None  # remove the circular reference for garbage collection
-		pop.del_from_population(self._owner_bug)
+		pop.del_from_population(self._pop_handle)
 		self._owner_bug = None
 
 
@@ -132,11 +153,14 @@ class BugPopulation:
 			pop_type: is the type of this population"""
 
 		self._pop_type = pop_type
-		self._pop_objects = []  # list of all of the bugs in the population. if use unique key could make it a dict
+		self._pop_objects = {}  # handle -> bug for all of the bugs in the population. dict keeps the order added
+		self._next_handle = count()
 
 		# call all of the specific NEAT related initializations
 		self.NEAT_init(NEAT_config)
 
+		self.brains = bb.BrainBatch(NEAT_config)  # runs the brains of the population's bugs together
+
 	def get_config(self):
 		return self.config
 
@@ -237,25 +261,35 @@ class BugPopulation:
 											num_genomes=1)
 		return genomes
 
+	def get_new_genomes(self, num_genomes):
+		"""same as calling get_new_genome num_genomes times.  returns a list of one entry genome dictionaries"""
+		genomes = self.reproduction.create_new(self.config.genome_type, self.config.genome_config, num_genomes)
+		return [{key: genome} for key, genome in genomes.items()]
+
 	def gather_genomes(self):
 		# since NEAT works on a dictionary of genomes, put them in a form that can be passed
 		genomes = {}
-		for pop_obj in self._pop_objects:  # loop through the current bug population
+		for pop_obj in self._pop_objects.values():  # loop through the current bug population
 			genomes.update(pop_obj.pi.get_genome())
 		return genomes
 
 	def add_to_population(self, bug):
-		if bug not in self._pop_objects:  # make sure is only added once
-			self._pop_objects.append(bug)
-
-	def del_from_population(self, bug):
-		"""search for the bug within the population and remove it without deleting the object. \
+		"""returns the handle used to remove the bug.  The population interface only adds a bug once"""
+		handle = next(self._next_handle)
+		self._pop_objects[handle] = bug
+		return handle
+
+	def add_all_to_population(self, bugs):
+		"""same as add_to_population for each bug, returns their handles"""
+		handles = [next(self._next_handle) for bug in bugs]
+		self._pop_objects.update(zip(handles, bugs))
+		return handles
+
+	def del_from_population(self, handle):
+		"""remove the bug from the population without deleting the object. \
 			This should be called when the bug is killed"""
-
-		# find object in list and remove it
-		# See article: https://stackoverflow.com/questions/1207406/how-to-remove-items-from-a-list-while-iterating
-		# somelist[:] = [x for x in somelist if not determine(x)]
-		self._pop_objects = [po for po in self._pop_objects if not po == bug]
+		if self._pop_objects.pop(handle, None) is None:
+			logging.warning("bug is not in the population: " + str(handle))
 
 	def prune_population(self, new_genomes):
 		"""new_genomes: is a dictionary with all of the genomes that are to be in the updated population. \
@@ -275,7 +309,7 @@ class BugPopulation:
 		delete_set = old_set.difference(keep_set)  # get a list of genomes that aren't in the new set
 		add_set = new_set.difference(keep_set)     # get a list of genomes that weren't in the old set
 
-		for pop_obj in self._pop_objects:  # loop through the current bug population
+		for pop_obj in self._pop_objects.values():  # loop through the current bug population
 			if pop_obj.pi.am_i_in_this_list(delete_set):  # if current bug is to be deleted
 				# add to list of bugs go be deleted to pass back to the world
 				objs_to_del.append(pop_obj)
@@ -345,13 +379,25 @@ class BugPopulations:
 	def register(self, bug):
 		# look up in the dictionary to get correct population
 		# invoke add on that population
+		# returns the population and the handle needed to deregister
 		pop = self.lookup_population(bug.type)
-		pop.add_to_population(bug)  # intentionally crash if there isn't a pop
-		return pop
-
-	def deregister(self, bug):
-		pop = self.lookup_population(bug.type)
-		pop.remove_from_population(bug)  # intentionally crash if there isn't a pop
+		handle = pop.add_to_population(bug)  # intentionally crash if there isn't a pop
+		return pop, handle
+
+	def register_all(self, bugs):
+		"""register for a batch of bugs that were built while the world was spawning.  Their interfaces get the
+			handles"""
+		by_type = {}
+		for bug in bugs:
+			by_type.setdefault(bug.type, []).append(bug)
+		for bug_type, same_type in by_type.items():
+			pop = self.lookup_population(bug_type)
+			for bug, handle in zip(same_type, pop.add_all_to_population(same_type)):
+				bug.pi.set_population_handle(handle)
+
+	def deregister(self, bug_type, handle):
+		pop = self.lookup_population(bug_type)
+		pop.del_from_population(handle)  # intentionally crash if there isn't a pop
 
 	def load_config_file(self, population_type):
 		"""Used to load NEAT config file to drive NEAT API"""
@@ -370,9 +416,7 @@ class BugPopulations:
 
 		# TODO...if file doesn't exist, try using a default config file
 		# right now errors out if doesn't exist
-		config = NEAT.Config(NEAT.DefaultGenome, NEAT.DefaultReproduction,
-								NEAT.DefaultSpeciesSet, NEAT.DefaultStagnation,
-								config_path)
+		config = bb.load_config(config_path)  # also reads the network type for the brains
 
 		return config
 
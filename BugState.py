@@ -0,0 +1,328 @@
+import timeit
+import numpy as np
+
+from Pose import Pose
+
+'''
+Struct of arrays for the state of every bug in the world.
+
+Each bug gets a slot in the arrays when it is created and gives it back when it is killed.  The bug's attributes
+(position, heading, wheel velocities, energy, health, score, size) are StateFields, so bug.energy reads and writes
+the arrays and the rest of the code doesn't know the difference.  That lets the world move every bug and do the
+score and energy bookkeeping with a few array operations instead of one bug at a time.
+
+A bug's parts (eyes, hit boxes) never move relative to the bug, so each one gets a part slot holding its fixed
+offset from the bug and place() works out where every bug and every part is in one pass.
+
+If a bug doesn't have a slot (the world was made without a BugState), a field is kept in an attribute named after it
+with a leading underscore (e.g., bug._energy), so classes using __slots__ must have a slot for it.
+'''
+
+
+def apply_boundary(x, y, bounds, wrap):
+	"""returns arrays of the positions moved inside the world.  wrap: True to take them modulo the size of the world
+		(leaving one edge comes in the other edge by the same amount), otherwise they are clamped to the edges"""
+	width, height = bounds
+	if not wrap:
+		return np.clip(x, 0, width), np.clip(y, 0, height)
+	x = np.mod(x, width)
+	y = np.mod(y, height)
+	# a tiny negative number comes out of mod as the size of the world, which is the same place as 0
+	return np.where(x < width, x, 0.0), np.where(y < height, y, 0.0)
+
+
+class StateField:
+	"""a bug attribute that lives in its BugState, or on the bug itself if it doesn't have one"""
+
+	def __init__(self, on_change=None):
+		"""on_change: name of a method on the bug called with (old value, new value) each time it is set"""
+		self.on_change = on_change
+
+	def __set_name__(self, owner, name):
+		self.name = name
+		self.private = '_' + name
+
+	def __get__(self, bug, objtype=None):
+		if bug is None:
+			return self
+		if bug._state is None:
+			return getattr(bug, self.private)
+		return getattr(bug._state, self.name)[bug._slot]
+
+	def __set__(self, bug, value):
+		if self.on_change is not None:
+			old_value = getattr(bug, self.private, None) if bug._state is None else getattr(bug._state, self.name)[bug._slot]
+		if bug._state is None:
+			setattr(bug, self.private, value)
+		else:
+			getattr(bug._state, self.name)[bug._slot] = value
+		if self.on_change is not None:
+			getattr(bug, self.on_change)(old_value, value)
+
+
+class StatePose:
+	"""a position kept as x, y, theta (and mirror) arrays in a BugState, handed out as a Pose.
+		Changing the Pose that is handed out doesn't move the object, set the position again"""
+
+	def __init__(self, x, y, theta, mirror=None):
+		self.fields = (x, y, theta, mirror)
+
+	def __set_name__(self, owner, name):
+		self.name = name
+		self.private = '_' + name
+		# without a BugState, use whatever the base class does with the position
+		self.fallback = next((vars(base)[name] for base in owner.__mro__[1:] if name in vars(base)), None)
+
+	def __get__(self, obj, objtype=None):
+		if obj is None:
+			return self
+		state = obj._state
+		if state is None:
+			if self.fallback is not None:
+				return self.fallback.__get__(obj, objtype)
+			return getattr(obj, self.private)
+		slot = obj._slot
+		x, y, theta, mirror = self.fields
+		if mirror is None:
+			return Pose(getattr(state, x)[slot], getattr(state, y)[slot], getattr(state, theta)[slot])
+		return Pose(getattr(state, x)[slot], getattr(state, y)[slot], getattr(state, theta)[slot],
+					getattr(state, mirror)[slot])
+
+	def __set__(self, obj, pose):
+		state = obj._state
+		if state is None:
+			if self.fallback is not None:
+				self.fallback.__set__(obj, pose)
+			else:
+				setattr(obj, self.private, pose)
+			return
+		slot = obj._slot
+		x, y, theta, mirror = self.fields
+		getattr(state, x)[slot] = pose.x
+		getattr(state, y)[slot] = pose.y
+		getattr(state, theta)[slot] = pose.theta
+		if mirror is not None:
+			getattr(state, mirror)[slot] = pose.mirror
+
+
+class BugState:
+	"""arrays indexed by slot.  Slots of killed bugs are reused"""
+
+	FIELDS = ('x', 'y', 'theta', 'vel_r', 'vel_l', 'energy', 'health', 'score', 'size',
+			  'abs_x', 'abs_y', 'abs_theta', 'abs_mirror')
+	PART_FIELDS = ('part_owner', 'offset_x', 'offset_y', 'offset_theta', 'offset_mirror',
+				   'part_x', 'part_y', 'part_theta', 'part_mirror')
+
+	def __init__(self, bounds, wrap, capacity=64):
+		""" bounds: (width, height) of the world
+			wrap: True if bugs leaving one edge of the world enter on the other """
+		self._width, self._height = bounds
+		self._wrap = wrap
+		self._capacity = 0
+		self._free = []
+		self._part_capacity = 0
+		self._free_parts = []
+		self._parts_version = 0  # changes when a part is added or removed
+		self._placed_parts = (None, None)  # (parts version, used part slots)
+		for field in self.FIELDS:
+			setattr(self, field, np.zeros(0))
+		for field in self.PART_FIELDS:
+			setattr(self, field, np.zeros(0, dtype=int if field == 'part_owner' else float))
+		self.grow(capacity)
+		self.grow_parts(capacity * 2)
+
+	def __len__(self):
+		return self._capacity - len(self._free)
+
+	def add(self):
+		"""returns the slot for a new bug"""
+		if not self._free:
+			self.grow(self._capacity)
+		return self._free.pop()
+
+	def add_part(self, bug, part, offset):
+		"""gives part a slot.  offset: the fixed Pose of the part in the bug's frame"""
+		if not self._free_parts:
+			self.grow_parts(self._part_capacity)
+		slot = self._free_parts.pop()
+		self.part_owner[slot] = bug._slot
+		self.offset_x[slot] = offset.x
+		self.offset_y[slot] = offset.y
+		self.offset_theta[slot] = offset.theta
+		self.offset_mirror[slot] = offset.mirror
+		part._state = self
+		part._slot = slot
+		self._parts_version += 1
+		return slot
+
+	def remove(self, bug, parts=()):
+		"""gives the slots of the bug and its parts back.  Their fields are copied onto them so they still work
+			after they have been killed"""
+		for part in parts:
+			abs_position = part.abs_position
+			self.part_owner[part._slot] = -1
+			self._free_parts.append(part._slot)
+			part._state = None
+			part._slot = None
+			part.abs_position = abs_position
+		self._parts_version += 1
+
+		# the positions are copied as poses, the rest as the bug's StateFields
+		values = {field: getattr(self, field)[bug._slot] for field in self.FIELDS
+				  if isinstance(getattr(type(bug), field, None), StateField)}
+		rel_position = bug.rel_position
+		abs_position = bug.abs_position
+		self._free.append(bug._slot)
+		bug._state = None
+		bug._slot = None
+		for field, value in values.items():
+			setattr(bug, field, value)
+		bug.rel_position = rel_position
+		bug.abs_position = abs_position
+
+	def grow(self, amount):
+		for field in self.FIELDS:
+			setattr(self, field, np.concatenate((getattr(self, field), np.zeros(amount))))
+		self.abs_mirror[self._capacity:] = 1
+		self._free.extend(range(self._capacity + amount - 1, self._capacity - 1, -1))  # low slots get used first
+		self._capacity += amount
+
+	def grow_parts(self, amount):
+		for field in self.PART_FIELDS:
+			array = getattr(self, field)
+			setattr(self, field, np.concatenate((array, np.zeros(amount, dtype=array.dtype))))
+		self.part_owner[self._part_capacity:] = -1
+		self._free_parts.extend(range(self._part_capacity + amount - 1, self._part_capacity - 1, -1))
+		self._part_capacity += amount
+
+	def kinematic_move(self, slots, wheel_radius, wheel_separation):
+		"""Bug.kinematic_move for all of the slots at once using vel_r and vel_l.
+			returns the delta_x, delta_y, delta_theta arrays in each bug's own frame"""
+		vel_r = self.vel_r[slots]
+		vel_l = self.vel_l[slots]
+		delta_theta = (wheel_radius / wheel_separation) * (vel_r - vel_l)
+		temp_vect = (wheel_radius / 2) * (vel_r + vel_l)
+		delta_x = temp_vect * np.cos(delta_theta)
+		delta_y = temp_vect * np.sin(delta_theta)
+
+		# compose the move onto the current pose, i.e. rotate it into the world frame
+		theta = self.theta[slots]
+		c = np.cos(theta)
+		s = np.sin(theta)
+		self.x[slots] += c * delta_x - s * delta_y
+		self.y[slots] += s * delta_x + c * delta_y
+		self.theta[slots] = theta + delta_theta
+		self.adjust_for_boundary(slots)
+		return delta_x, delta_y, delta_theta
+
+	def place(self, slots, base):
+		"""sets abs position of the bugs in slots to base.compose(rel_position), then places every part"""
+		c = np.cos(base.theta)
+		s = np.sin(base.theta)
+		x = self.x[slots]
+		y = base.mirror * self.y[slots]
+		self.abs_x[slots] = base.x + c * x - s * y
+		self.abs_y[slots] = base.y + s * x + c * y
+		self.abs_theta[slots] = base.theta + base.mirror * self.theta[slots]
+		self.abs_mirror[slots] = base.mirror
+		self.place_parts()
+
+	def place_parts(self):
+		"""abs position of every part from its bug's abs position and its offset"""
+		version, parts = self._placed_parts
+		if version != self._parts_version:
+			parts = np.flatnonzero(self.part_owner >= 0)
+			self._placed_parts = (self._parts_version, parts)
+		owner = self.part_owner[parts]
+		theta = self.abs_theta[owner]
+		mirror = self.abs_mirror[owner]
+		c = np.cos(theta)
+		s = np.sin(theta)
+		x = self.offset_x[parts]
+		y = mirror * self.offset_y[parts]
+		self.part_x[parts] = self.abs_x[owner] + c * x - s * y
+		self.part_y[parts] = self.abs_y[owner] + s * x + c * y
+		self.part_theta[parts] = theta + mirror * self.offset_theta[parts]
+		self.part_mirror[parts] = mirror * self.offset_mirror[parts]
+
+	def adjust_for_boundary(self, slots):
+		"""same as BugWorld.adjust_for_boundary for all of the slots"""
+		self.x[slots], self.y[slots] = apply_boundary(self.x[slots], self.y[slots], (self._width, self._height), self._wrap)
+
+
+# --- Testing Code after this point --------------------------------------------------------------------------------
+
+def test_kinematic_move(num_bugs=100, num_steps=50, bounds=(1000, 800)):
+	"""moving all of the bugs at once must match moving them one at a time with poses"""
+	width, height = bounds
+	state = BugState(bounds, True, capacity=8)  # small so it has to grow
+	slots = np.array([state.add() for i in range(num_bugs)])
+	poses = [Pose(np.random.uniform(0, width), np.random.uniform(0, height), np.random.uniform(0, 2 * np.pi))
+			 for i in range(num_bugs)]
+	for slot, pose in zip(slots, poses):
+		state.x[slot], state.y[slot], state.theta[slot] = pose.x, pose.y, pose.theta
+	state.size[slots] = 10
+
+	for step in range(num_steps):
+		state.vel_r[slots] = np.random.uniform(-1, 1, num_bugs)
+		state.vel_l[slots] = np.random.uniform(-1, 1, num_bugs)
+		state.kinematic_move(slots, 5.0, 20.0)
+		for n, slot in enumerate(slots):
+			delta_theta = 0.25 * (state.vel_r[slot] - state.vel_l[slot])
+			temp_vect = 2.5 * (state.vel_r[slot] + state.vel_l[slot])
+			pose = poses[n].compose(Pose(temp_vect * np.cos(delta_theta), temp_vect * np.sin(delta_theta), delta_theta))
+			pose.x %= width
+			pose.y %= height
+			poses[n] = pose
+
+	assert np.allclose(state.x[slots], [p.x for p in poses]), "x doesn't match"
+	assert np.allclose(state.y[slots], [p.y for p in poses]), "y doesn't match"
+	assert np.allclose(state.theta[slots], [p.theta for p in poses]), "theta doesn't match"
+
+
+def test_boundary(num=10000, bounds=(1000, 800)):
+	"""wrapping must keep how far past the edge a position went, clamping must stop at the edge"""
+	width, height = bounds
+	x = np.random.uniform(-3 * width, 3 * width, num)
+	y = np.random.uniform(-3 * height, 3 * height, num)
+	x[:4] = [0, width, -1e-17, width + 5]  # the edges themselves
+	y[:4] = [0, height, -1e-17, -5]
+
+	wx, wy = apply_boundary(x, y, bounds, True)
+	assert np.all((0 <= wx) & (wx < width)) and np.all((0 <= wy) & (wy < height)), "wrapped outside the world"
+	for n in range(num):
+		assert np.isclose(wx[n], x[n] % width) or np.isclose(abs(wx[n] - x[n] % width), width), "x wrapped wrong"
+		assert np.isclose(wy[n], y[n] % height) or np.isclose(abs(wy[n] - y[n] % height), height), "y wrapped wrong"
+	assert np.isclose(wx[3], 5) and np.isclose(wy[3], height - 5), "should come in the other side by the overshoot"
+
+	cx, cy = apply_boundary(x, y, bounds, False)
+	assert np.array_equal(cx, [min(max(p, 0), width) for p in x]), "x clamped wrong"
+	assert np.array_equal(cy, [min(max(p, 0), height) for p in y]), "y clamped wrong"
+
+	# a bug driving straight over the edge keeps going at the same speed
+	state = BugState(bounds, True)
+	slot = np.array([state.add()])
+	state.x[slot], state.y[slot], state.theta[slot] = width - 1, height / 2, 0
+	state.vel_r[slot] = state.vel_l[slot] = 1.0
+	for step in range(5):
+		state.kinematic_move(slot, 5.0, 20.0)
+	assert np.isclose(state.x[slot][0], (width - 1 + 5 * 5.0) % width), "position jumped at the edge"
+
+
+def benchmark_boundary(num=100000, number=20):
+	"""positions per second through apply_boundary and through a Python loop of the same rule"""
+	bounds = (1000, 800)
+	x = np.random.uniform(-100, 1100, num)
+	y = np.random.uniform(-100, 900, num)
+	vector_time = timeit.timeit(lambda: apply_boundary(x, y, bounds, True), number=number) / number
+
+	xs, ys = x.tolist(), y.tolist()
+	loop_time = timeit.timeit(lambda: [(px % 1000, py % 800) for px, py in zip(xs, ys)], number=number) / number
+	print("wrap {} positions: array {:.0f}M/sec, loop {:.1f}M/sec, {:.0f}x faster".format(
+		num, num / vector_time / 1e6, num / loop_time / 1e6, loop_time / vector_time))
+
+
+if __name__ == "__main__":
+	test_kinematic_move()
+	test_boundary()
+	benchmark_boundary()
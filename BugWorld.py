@@ -1,6 +1,7 @@
 import logging
 import numpy as np
 import random
+import tracemalloc
 from itertools import count
 
 #comment out debugging imports
@@ -12,12 +13,11 @@ from itertools import count
 #os.environ["PATH"] += os.pathsep + 'C:/Program Files (x86)/Graphviz2.38/bin/'
 
 
-#Going to use 3D matrices even if in 2d
-#See http://matthew-brett.github.io/transforms3d/ for details on the lib used
+#Positions are 2D poses (x, y, theta), see Pose
 #Object's local coord frame is in the x,y plane and faces in the x direction.
 #Positive rotation follow RHR, x-axis into the y-axis...so z is up.
-import transforms3d.affines as AFF
-import transforms3d.euler as E
+from Pose import Pose
+from Scheduler import Scheduler
 
 logger = logging.getLogger()
 logger.setLevel(logging.ERROR)
@@ -31,6 +31,8 @@ import pygame
 
 # assume 2D graphics and using Pygame to render.
 class PGObject():
+	__slots__ = ()  # the subclasses say what they store
+
 	color = (0, 0, 0)  # default, must be overwritten
 	size = 1  # default, must be overwritten
 	visible = True  # will indicate whether to draw the object or not
@@ -128,19 +130,31 @@ class BWObject(PGObject):  # Bug World Object
 	#has a size
 	#has a name
 	#stores an absolute position to prevent recalculating it when passing to contained objects.
+	#the absolute position is only worked out when asked for, after the object or its container has moved
 	#BWO's should have a draw method that includes itself
 	#BWO's should have an update method that includes itself and any subcomponents
 
+	STATIC = False  # True if objects of this class never move by themselves, so the world doesn't update them
+	EMITS = ()  # collision types the object is registered as an emitter for, see register_collisions
+	DETECTS = ()  # and as a detector
+
+	# there can be a lot of these, so no per object __dict__.  Subclasses have to list anything new they store
+	__slots__ = ('bug_world', '_subcomponents', '_parent', '_base', '_abs_position', '_rel_position',
+				 'name', 'size', 'color', 'default_color', 'type', 'ci', 'entity_id')
+
 	def __init__(self, bug_world, starting_pos, name="BWOBject"):
 		self.bug_world = bug_world 		  # the world that holds this object
+		self.entity_id = None  # set when it is added to the world's EntityRegistry
+		self._subcomponents = []  # a list of subcomponents in the object
+		self._parent = None  # the object this is a subcomponent of, if any
+		self._base = bug_world.rel_position  # container's abs position if there is no parent
+		self._abs_position = None  # absolute position in the BugWorld, None until it is worked out
 		self.rel_position = starting_pos  # relative the position that holds it (e.g., it is a subcomponent of a bug)
-		self.abs_position = starting_pos  # absolute position in the BugWorld
 		self.name = name
 		self.size = 1  # default...needs to be overridden
 		self.color = Color.BLACK  # default...needs to be overridden
 		self.default_color = self.color
 		self.type = BWOType.OBJ  # default...needs to be overridden
-		self._subcomponents = []  # a list of subcomponents in the object
 
 	def __repr__(self):
 		return self.name + ": abs position={}".format(self.abs_position)  # print its name and transform
@@ -152,8 +166,36 @@ class BWObject(PGObject):  # Bug World Object
 	def get_rel_position(self):  # position relative to its container
 		return self.rel_position
 
+	@property
+	def rel_position(self):
+		return self._rel_position
+
+	@rel_position.setter
+	def rel_position(self, pos_transform):
+		self._rel_position = pos_transform
+		self.mark_dirty()
+
+	@property
+	def abs_position(self):
+		if self._abs_position is None:
+			base = self._base if self._parent is None else self._parent.abs_position
+			self._abs_position = base.compose(self._rel_position)
+		return self._abs_position
+
+	@abs_position.setter
+	def abs_position(self, pos_transform):
+		self._abs_position = pos_transform
+		for sc in self._subcomponents:
+			sc.mark_dirty()
+
+	def mark_dirty(self):
+		"""the abs position has to be worked out again, and so do the ones of everything mounted on this"""
+		self._abs_position = None
+		for sc in self._subcomponents:
+			sc.mark_dirty()
+
 	def set_abs_position(self, base_transform):
-		self.abs_position = np.matmul(base_transform, self.rel_position)
+		self.abs_position = base_transform.compose(self.rel_position)
 		return self.abs_position
 
 	def get_abs_position(self):
@@ -168,10 +210,21 @@ class BWObject(PGObject):  # Bug World Object
 	def get_size(self):
 		return self.size
 
+	def register_collisions(self):
+		"""registers self.ci for EMITS and DETECTS.  If the world is spawning a batch, BugWorld.spawn registers the
+			whole batch at once instead"""
+		if self.bug_world.spawning:
+			return
+		for collision_type in self.EMITS:
+			self.ci.register_as_emitter(self, collision_type, self.STATIC)
+		for collision_type in self.DETECTS:
+			self.ci.register_as_detector(self, collision_type)
+
 	def update(self, base):
-		# eyes don't move independent of bug, so relative pos won't change.
-		self.set_abs_position(base)  # update it based on the passed in ref frame
-		self.update_subcomponents(self.abs_position)
+		# nothing to do unless the ref frame changed.  abs positions are worked out when they are asked for
+		if base is not self._base:
+			self._base = base
+			self.mark_dirty()
 
 	def update_subcomponents(self, base):
 		for sc in self._subcomponents:
@@ -188,10 +241,34 @@ class BWObject(PGObject):  # Bug World Object
 
 	def add_subcomponent(self, bwo):
 		self._subcomponents.append(bwo)
+		bwo._parent = self
+		bwo.mark_dirty()
 
 	def reset_fitness(self):
 		pass
 
+	def health_changed(self, old_health, health):
+		"""tells the world when the object dies, so it doesn't have to check everything's health every step"""
+		if old_health is not None and old_health > 0 >= health and self.bug_world is not None:
+			self.bug_world.entities.mark_for_removal(self)
+
+	def release(self):
+		"""takes it out of the collisions like kill, but keeps it in one piece so it can be revived.  See EntityPool"""
+		for sc in self._subcomponents:
+			sc.release()
+		ci = getattr(self, 'ci', None)
+		if ci is not None:
+			ci.deregister_all(keep=True)
+
+	def rejoin(self):
+		"""registers a released subcomponent, and its subcomponents, for its collisions again"""
+		for collision_type in self.EMITS:
+			self.ci.register_as_emitter(self, collision_type, self.STATIC)
+		for collision_type in self.DETECTS:
+			self.ci.register_as_detector(self, collision_type)
+		for sc in self._subcomponents:
+			sc.rejoin()
+
 	def kill(self):
 		"""this is necessary to make sure all of subcomponents and interfaces are cleaned up"""
 		self.kill_subcomponents()
@@ -208,10 +285,146 @@ class BWObject(PGObject):  # Bug World Object
 			sc.kill()
 
 
+class StaticBWObject(BWObject):
+	"""An object that never moves by itself (e.g., food, obstacles).  Its collisions are worked out against an index
+		that is kept between steps, so it tells the collision system when it is moved or resized"""
+
+	STATIC = True
+
+	__slots__ = ('_size', '_health')
+
+	@property
+	def health(self):
+		return self._health
+
+	@health.setter
+	def health(self, health):
+		old_health = getattr(self, '_health', None)
+		self._health = health
+		self.health_changed(old_health, health)
+
+	@property
+	def size(self):
+		return self._size
+
+	@size.setter
+	def size(self, size):
+		old_size = getattr(self, '_size', None)
+		self._size = size
+		if old_size is not None and size != old_size:
+			self.static_changed(rebuild=size > old_size)
+
+	def mark_dirty(self):
+		super().mark_dirty()
+		self.static_changed()
+
+	def static_changed(self, rebuild=True):
+		ci = getattr(self, 'ci', None)  # not registered yet while it is being built
+		if ci is not None:
+			ci.static_changed(rebuild)
+
+
+class EntityRegistry:
+	"""The top level objects in the world (not their subcomponents), by an integer id.  Also keeps the objects of
+		each type, the ones that move, and the ids of objects that died and are waiting to be removed"""
+
+	def __init__(self):
+		self._entities = {}  # id -> object, in the order they were added
+		self._by_type = {}  # BWOType -> {id: object}.  dicts so they keep the order too
+		self._dynamic = {}  # id -> object for objects that aren't STATIC
+		self._pending = set()  # ids of objects that died since the last take_pending
+		self._next_id = count()
+
+	def __len__(self):
+		return len(self._entities)
+
+	def __iter__(self):
+		return iter(self._entities.values())
+
+	def __contains__(self, bwo):
+		return self._entities.get(bwo.entity_id) is bwo
+
+	def add(self, bwo):
+		"""returns the id given to the object"""
+		entity_id = bwo.entity_id = next(self._next_id)
+		self._entities[entity_id] = bwo
+		self._by_type.setdefault(bwo.type, {})[entity_id] = bwo
+		if not bwo.STATIC:
+			self._dynamic[entity_id] = bwo
+		return entity_id
+
+	def remove(self, bwo):
+		"""takes the object out of the registry.  Doesn't kill it"""
+		if bwo not in self:
+			logging.warning("not in the world: " + bwo.name)
+			return
+		entity_id = bwo.entity_id
+		del self._entities[entity_id]
+		del self._by_type[bwo.type][entity_id]
+		self._dynamic.pop(entity_id, None)
+		self._pending.discard(entity_id)
+
+	def get(self, entity_id):
+		return self._entities.get(entity_id)
+
+	def of_type(self, *bwo_types):
+		"""list of the objects of the types"""
+		objs = []
+		for bwo_type in bwo_types:
+			objs.extend(self._by_type.get(bwo_type, {}).values())
+		return objs
+
+	def dynamic(self):
+		"""list of the objects that move by themselves"""
+		return list(self._dynamic.values())
+
+	def mark_for_removal(self, bwo):
+		if bwo in self:
+			self._pending.add(bwo.entity_id)
+
+	def take_pending(self):
+		"""returns the objects marked for removal, in the order they were added, and forgets them"""
+		pending = [self._entities[entity_id] for entity_id in sorted(self._pending)]
+		self._pending.clear()
+		return pending
+
+
+class EntityPool:
+	"""Objects taken out of the world, kept by type so the world can revive them instead of building new ones.
+		An object that can be pooled has release() and revive(starting_pos, name, genome)"""
+
+	def __init__(self, max_size=1000):
+		""" max_size: most objects kept of each type, any more are killed """
+		self._free = {}  # BWOType -> released objects
+		self.max_size = max_size
+		self.reused = 0  # count of objects handed back out
+
+	def __len__(self):
+		return sum(len(free) for free in self._free.values())
+
+	def put(self, bwo):
+		"""takes the object out of the world.  It is kept if there is room, otherwise it is killed"""
+		free = self._free.setdefault(bwo.type, [])
+		if len(free) < self.max_size:
+			bwo.release()
+			free.append(bwo)
+		else:
+			bwo.kill()
+
+	def take(self, bwo_type):
+		"""returns a released object of the type, or None if there aren't any.  It has to be revived"""
+		free = self._free.get(bwo_type)
+		if not free:
+			return None
+		self.reused += 1
+		return free.pop()
+
+
 import Bug
 import Collisions as coll
 import BugPopulation as pop
 import BugBrain as bb
+import BugState as bs
 
 
 #Color class so can separate out code from PG specific stuff.
@@ -256,7 +469,7 @@ class BWOType:
 					OMN: 'OMN',
 					CARN: 'CARN',
 					OBST: 'OBST',
-					MEAT: 'BUG',
+					MEAT: 'MEAT',
 					PLANT: 'PLANT',
 					EYE: 'EYE',
 					EHB: 'EHB',
@@ -270,10 +483,19 @@ class BWOType:
 class PhysicalCollisionMatrix(coll.CollisionMatrix):
 	"""This class controls what happens when objects physcialy collide"""
 
+	# if True, all of a step's collisions are handed over at once and food and obstacle hits are handled with
+	# array operations.  The other pairs still go through their per pair method
+	BATCH_DISPATCH = True
+	BITE_SIZE = 10  # most food a bug can take from a plant or meat per step
+
 	def __init__(self, collisions):
-		super().__init__(self.get_collision_dictionary())
+		super().__init__(self.get_collision_dictionary(), batch_dictionary=self.get_batch_dictionary())
 		self.collisions = collisions
-		self.collisions.set_collision_handler(coll.Collisions.PHYSICAL, self.invoke_handler)
+		if self.BATCH_DISPATCH:
+			self.collisions.set_collision_handler(coll.Collisions.PHYSICAL, self.invoke_batch_handler,
+												  self.get_handled_pairs(), batch=True)
+		else:
+			self.collisions.set_collision_handler(coll.Collisions.PHYSICAL, self.invoke_handler, self.get_handled_pairs())
 
 # Bug to Bug interactions
 	def herb_omn(self, herb, omn):  # handle herbivore an omnivore collision
@@ -389,6 +611,62 @@ class PhysicalCollisionMatrix(coll.CollisionMatrix):
 		self.print_collision(carn, obst)
 		carn.health -= 1  # ouch obstacles hurt
 
+# Batch versions, get all hits of one pair type as index arrays into bugs and others
+	def batch_eat(self, bugs, foods, bug_idx, food_idx, food_amount):
+		"""same as herb_plant and friends for a whole batch.  Bites on the same food are taken in hit order, so
+			one that runs out feeds the same bugs it would have fed one hit at a time.
+			food_amount: name of the BugWorld total to take the food from"""
+		food_slots, food_of_hit = np.unique(food_idx, return_inverse=True)
+		food_of_hit = food_of_hit.ravel()
+		food = [foods[i] for i in food_slots.tolist()]
+		health = np.array([f.health for f in food])
+
+		# how many bites were taken from the same food before this one
+		order = np.argsort(food_of_hit, kind='stable')
+		first_hit = np.searchsorted(food_of_hit[order], food_of_hit[order])
+		bites_before = np.empty_like(order)
+		bites_before[order] = np.arange(len(order)) - first_hit
+		food_consumed = np.clip(health[food_of_hit] - self.BITE_SIZE * bites_before, 0, self.BITE_SIZE)
+
+		bug_slots, bug_of_hit = np.unique(bug_idx, return_inverse=True)
+		energy_gained = np.zeros(len(bug_slots), dtype=food_consumed.dtype)
+		np.add.at(energy_gained, bug_of_hit.ravel(), food_consumed)
+		for i, energy in zip(bug_slots.tolist(), energy_gained.tolist()):
+			bugs[i].energy += energy
+
+		eaten = np.zeros(len(food), dtype=food_consumed.dtype)
+		np.add.at(eaten, food_of_hit, food_consumed)
+		bites = np.bincount(food_of_hit[food_consumed > 0], minlength=len(food))
+		for f, amount, num_bites in zip(food, eaten.tolist(), bites.tolist()):
+			f.health -= amount
+			if f.size > 1:
+				f.size = max(f.size - num_bites, 1)  # makes sure that if the object is in BWO, it is displayed
+
+		bug_world = bugs[bug_slots[0]].bug_world
+		setattr(bug_world, food_amount, getattr(bug_world, food_amount) - eaten.sum().item())
+
+	def batch_eat_plant(self, bugs, plants, bug_idx, plant_idx):
+		self.batch_eat(bugs, plants, bug_idx, plant_idx, 'global_plant_food_amount')
+
+	def batch_eat_meat(self, bugs, meat, bug_idx, meat_idx):
+		self.batch_eat(bugs, meat, bug_idx, meat_idx, 'global_meat_food_amount')
+
+	def batch_obst(self, bugs, obsts, bug_idx, obst_idx):
+		bug_slots, hits = np.unique(bug_idx, return_counts=True)
+		for i, num_hits in zip(bug_slots.tolist(), hits.tolist()):
+			bugs[i].health -= num_hits  # ouch obstacles hurt
+
+	def get_batch_dictionary(self):
+		return {  # pairs that can be handled for a whole step at once, the rest use get_collision_dictionary
+			(BWOType.HERB, BWOType.PLANT): self.batch_eat_plant,
+			(BWOType.OMN, BWOType.PLANT): self.batch_eat_plant,
+			(BWOType.OMN, BWOType.MEAT): self.batch_eat_meat,
+			(BWOType.CARN, BWOType.MEAT): self.batch_eat_meat,
+			(BWOType.HERB, BWOType.OBST): self.batch_obst,
+			(BWOType.OMN, BWOType.OBST): self.batch_obst,
+			(BWOType.CARN, BWOType.OBST): self.batch_obst
+		}
+
 	def get_collision_dictionary(self):
 		cd = {  # look up which function to call when two objects of certain types collide
 			(BWOType.HERB, BWOType.OMN): self.herb_omn,
@@ -414,10 +692,20 @@ class PhysicalCollisionMatrix(coll.CollisionMatrix):
 class VisualCollisionMatrix(coll.CollisionMatrix):
 	"""This class controls what happens when a bug's eye hit box collides with something that emits visual info"""
 
+	# if True, the collision system only reports the nearest thing each eye hit box sees instead of every overlap
+	NEAREST_ONLY = True
+	NUM_NEAREST = 1  # how many of the closest objects to report.  The brain only uses the closest one
+
+	EYE_INPUTS = {'R': 'right_eye', 'L': 'left_eye'}  # eye hit box name -> brain input it feeds
+
 	def __init__(self, collisions):
 		super().__init__(self.get_collision_dictionary())
 		self.collisions = collisions
-		self.collisions.set_collision_handler(coll.Collisions.VISUAL, self.invoke_handler)
+		if self.NEAREST_ONLY:
+			self.collisions.set_collision_handler(coll.Collisions.VISUAL, self.invoke_nearest_handler,
+												  self.get_handled_pairs(), self.NUM_NEAREST)
+		else:
+			self.collisions.set_collision_handler(coll.Collisions.VISUAL, self.invoke_handler, self.get_handled_pairs())
 
 # Eye to Bug interactions, i.e., when a bug sees another bug or object
 	def ehb_omn(self, ehb, omn):  # handle herbivore an omnivore collision
@@ -440,20 +728,30 @@ class VisualCollisionMatrix(coll.CollisionMatrix):
 		self.print_collision(ehb, meat )
 		logging.info('I see meat!')
 
+	def ehb_obst(self, ehb, obst):
+		self.print_collision(ehb, obst )
+		logging.info('I see an obstacle!')
+
 	def get_collision_dictionary(self):
 		cd = {  # look up which function to call when two objects of certain types collide
 			(BWOType.EHB, BWOType.OMN): self.ehb_omn,
 			(BWOType.EHB, BWOType.CARN): self.ehb_carn,
 			(BWOType.EHB, BWOType.HERB): self.ehb_herb,
 			(BWOType.EHB, BWOType.PLANT): self.ehb_plant,
-			(BWOType.EHB, BWOType.MEAT): self.ehb_meat
+			(BWOType.EHB, BWOType.MEAT): self.ehb_meat,
+			(BWOType.EHB, BWOType.OBST): self.ehb_obst
 		}
 		return cd
 
-	def extract_collision_data(self, detector, emitter): # for visual collisions
+	def extract_collision_data(self, detector, emitter, dist_sqrd=None): # for visual collisions
 		"""
 			want the distance between the emitter object and the bug...not the eye_hitbox
+			if the collision group already worked out the distance to the eye hit box, use that instead of
+			calculating it again.  It is only used to compare what an eye sees, so either distance will do
 		"""
+		if dist_sqrd is not None:
+			return {'dist_sqrd':dist_sqrd}
+
 		detector = detector.owner  # use the the bug as the detector
 
 		dx = detector.get_abs_x() - emitter.get_abs_x()
@@ -461,23 +759,64 @@ class VisualCollisionMatrix(coll.CollisionMatrix):
 		dist_sqrd = (dx * dx) + (dy * dy)
 		return {'dist_sqrd':dist_sqrd}
 
-	def invoke_handler(self, detector, emitter):  # for visual collisions
-		collision_data = self.extract_collision_data(detector, emitter)
+	def invoke_handler(self, detector, emitter, dist_sqrd=None):  # for visual collisions
+		collision_data = self.extract_collision_data(detector, emitter, dist_sqrd)
 		detector.color = emitter.color
 		owner = detector.owner
 
 		dist_sqrd = collision_data.get('dist_sqrd', 0)
-		# TODO: hide this implementation detail for the eye hitbox name
-		if detector.name == 'R':
-			brain_data = {'right_eye': (emitter.color, dist_sqrd)}
-		elif detector.name == 'L':
-			brain_data = {'left_eye': (emitter.color, dist_sqrd)}
-		else:  # should be an eye, if not just return
+		eye_input = self.EYE_INPUTS.get(detector.name)
+		if eye_input is None:  # should be an eye, if not just return
 			return
 
-		owner.bi.update_brain_inputs(brain_data)
+		owner.bi.update_eye_input(eye_input, emitter.color, dist_sqrd)  # keeps the closest
 		logging.info(owner.name + ':' + detector.name + ' saw ' + emitter.name + ' at a distance of: ' + str(round(collision_data.get("dist_sqrd"))))
 
+	def invoke_nearest_handler(self, detector, hits):  # for visual collisions when only the nearest are reported
+		"""hits: list of (emitter, dist_sqrd) closest first.  dist_sqrd is measured from the eye hit box"""
+		eye_input = self.EYE_INPUTS.get(detector.name)
+		if eye_input is None:  # should be an eye, if not just return
+			return
+
+		emitter, dist_sqrd = hits[0]
+		detector.color = emitter.color
+		detector.owner.bi.set_eye_input(eye_input, emitter.color, dist_sqrd)  # already the closest so no need to compare
+
+
+class RayVision:
+	"""Casts NUM_RAYS rays spread evenly over FIELD_OF_VIEW from the front of every bug at once and tells each
+	bug's brain the color of the first thing each ray hits (not how far away, the brain has no input for it).  Replaces the eye hit boxes.
+	Anything registered as a visual emitter can be seen.  Rays go from the right to the left side of the bug
+	so with two rays they line up with the right and left eyes"""
+
+	NUM_RAYS = 2
+	FIELD_OF_VIEW = np.deg2rad(60)
+	RANGE = 60  # about as far as the eye hit boxes used to reach
+
+	def __init__(self, collisions):
+		self.collisions = collisions
+		if self.NUM_RAYS > 1:
+			self._angles = np.linspace(-self.FIELD_OF_VIEW / 2, self.FIELD_OF_VIEW / 2, self.NUM_RAYS)
+		else:
+			self._angles = np.zeros(1)  # in the bug's frame
+
+	def sense(self, bugs):
+		if not bugs:
+			return
+		x = np.array([bug.abs_position.x for bug in bugs], dtype=float)
+		y = np.array([bug.abs_position.y for bug in bugs], dtype=float)
+		theta = np.array([bug.abs_position.theta for bug in bugs], dtype=float)
+		mirror = np.array([bug.abs_position.mirror for bug in bugs], dtype=float)
+		angles = theta[:, np.newaxis] + mirror[:, np.newaxis] * self._angles  # rotate into the world
+		directions = np.stack((np.cos(angles), np.sin(angles)), axis=2)
+		owners = np.array([id(bug.owner) for bug in bugs], dtype=np.int64)
+		emitters, em_idx, _ = self.collisions.cast_rays(coll.Collisions.VISUAL, x, y, directions, self.RANGE, owners)
+
+		colors = np.array([emitter.color for emitter in emitters] + [(0, 0, 0)], dtype=float)  # -1 sees black
+		seen = colors[em_idx]
+		for bug, ray_colors in zip(bugs, seen):
+			bug.bi.set_vision(ray_colors)
+
 
 class BugWorld:  # defines the world, holds the objects, defines the rules of interaction
 
@@ -486,6 +825,24 @@ class BugWorld:  # defines the world, holds the objects, defines the rules of in
 	BOUNDARY_HEIGHT = 800
 	BOUNDARY_WRAP = True  # controls whether bugs go off one side and enter the other (WRAP), or hit a wall
 
+	# how the collision system finds pairs to test. see Collisions for the choices, pick the fastest for the density
+	BROAD_PHASE = coll.UniformGridBroadPhase
+
+	# if True, bugs see with rays (see RayVision) instead of eye hit boxes
+	RAY_VISION = True
+
+	# if True, the bugs' state is kept in arrays and all of the bugs are moved at once (see BugState)
+	BUG_STATE_ARRAYS = True
+
+	# if True, the brains of the bugs in a population are run together (see BugBrain.BrainBatch)
+	BATCH_BRAINS = True
+
+	# how often parts of the update run as name: (period, phase), see Scheduler.  Moving, physical collisions and
+	# energy/score run every step.  'brains': bugs think, in between they keep their wheel velocities.  'vision':
+	# the bugs look (rays or eye hit boxes), what they saw is kept until their brain uses it.  'populations': count
+	# down to reproduction.  e.g., {'brains': (3, 0), 'vision': (2, 1)}
+	UPDATE_RATES = {'brains': (1, 0), 'vision': (1, 0), 'populations': (1, 0)}
+
 	# controls the initial number of objects in the World to start
 	NUM_CARNIVORE_BUGS = 0
 	NUM_OMNIVORE_BUGS = 0
@@ -497,8 +854,8 @@ class BugWorld:  # defines the world, holds the objects, defines the rules of in
 	# control reproduction in the world
 	NUM_STEPS_BEFORE_REPRODUCTION = 500
 
-	IDENTITY = np.identity(4, int)  # make a specific version in case change dimension from 3 to 2
-	MAP_TO_CANVAS = [[1,0,0,0], [0,-1,0,BOUNDARY_HEIGHT], [0,0,-1,0], [0,0,0,1]]  # flip x-axis and translate origin
+	IDENTITY = Pose()
+	MAP_TO_CANVAS = Pose(0, BOUNDARY_HEIGHT, 0, mirror=-1)  # flip x-axis and translate origin
 
 	# used to control what types of objects will be controlled by the population interface
 	valid_population_types = {BWOType.OMN, BWOType.HERB, BWOType.CARN}  # the different types of populations allowed
@@ -506,67 +863,87 @@ class BugWorld:  # defines the world, holds the objects, defines the rules of in
 	global_plant_food_amount = 0
 	global_meat_food_amount = 0
 
+	spawning = False  # True while spawn is building a batch
+	POOLING = True  # if True, objects taken out of the world are kept and reused.  see EntityPool
+
+	MEMORY_TYPES = (BWOType.HERB, BWOType.OBST, BWOType.PLANT, BWOType.MEAT)  # what measure_memory reports on
 
 	def __init__(self):
 
 		self.rel_position = BugWorld.MAP_TO_CANVAS  # maps Bug World coords to the canvas coords in Pygame
-		self.WorldObjects = []  # collection of all of the objects in the world
+		self.entities = EntityRegistry()  # all of the objects in the world
+		self.dead_bugs = {}  # entity id -> bug that died but is still in its population until it reproduces
+		self.pool = EntityPool() if BugWorld.POOLING else None  # dead objects are reused from here
 
-		# instantiate the collision system
-		self.collisions = coll.Collisions()
+		# instantiate the collision system.  Collisions are checked in canvas coords, which cover the same area
+		self.collisions = coll.Collisions((BugWorld.BOUNDARY_WIDTH, BugWorld.BOUNDARY_HEIGHT), BugWorld.BOUNDARY_WRAP,
+										  BugWorld.BROAD_PHASE)
 		self.pcm = PhysicalCollisionMatrix(self.collisions)
 		self.vcm = VisualCollisionMatrix(self.collisions)
+		self.vision = RayVision(self.collisions) if BugWorld.RAY_VISION else None
+		self.bug_state = None
+		if BugWorld.BUG_STATE_ARRAYS:
+			self.bug_state = bs.BugState((BugWorld.BOUNDARY_WIDTH, BugWorld.BOUNDARY_HEIGHT), BugWorld.BOUNDARY_WRAP)
 
 		# instantiate the populations system
 		self.populations = pop.BugPopulations(self, self.valid_population_types)
 		self.sim_step = 0
 		self.reproduction_countdown = BugWorld.NUM_STEPS_BEFORE_REPRODUCTION
+		self.scheduler = Scheduler(BugWorld.UPDATE_RATES)
 
-		for i in range(0, BugWorld.NUM_HERBIVORE_BUGS):  # instantiate all of the Herbivores with a default name
-			start_pos = BugWorld.get_random_location_in_world(self)
-			self.WorldObjects.append(Herbivore(self, start_pos, "H" + str(i)))
-
-		for i in range(0, BugWorld.NUM_CARNIVORE_BUGS):
-			start_pos = BugWorld.get_random_location_in_world(self)
-			self.WorldObjects.append(Carnivore(self, start_pos, "C" + str(i)))
-
-		for i in range(0, BugWorld.NUM_OMNIVORE_BUGS):
-			start_pos = BugWorld.get_random_location_in_world(self)
-			self.WorldObjects.append(Omnivore(self, start_pos, "O" + str(i)))
-
-		for i in range(0, BugWorld.NUM_OBSTACLES):
-			start_pos = BugWorld.get_random_location_in_world(self)
-			self.WorldObjects.append(Obstacle(self, start_pos, "B" + str(i)))
+		self.spawn(BWOType.HERB, BugWorld.NUM_HERBIVORE_BUGS, name="H")  # all of the Herbivores with a default name
+		self.spawn(BWOType.CARN, BugWorld.NUM_CARNIVORE_BUGS, name="C")
+		self.spawn(BWOType.OMN, BugWorld.NUM_OMNIVORE_BUGS, name="O")
+		self.spawn(BWOType.OBST, BugWorld.NUM_OBSTACLES, name="B")
+		self.spawn(BWOType.PLANT, BugWorld.NUM_PLANT_FOOD, name="P")
+		self.spawn(BWOType.MEAT, BugWorld.NUM_MEAT_FOOD, name="M")
 
-		for i in range(0, BugWorld.NUM_PLANT_FOOD ):
-			start_pos = BugWorld.get_random_location_in_world(self)
-			plant = Plant(self, start_pos, "P" + str(i))
-			self.WorldObjects.append(plant)
-
-		for i in range(0, BugWorld.NUM_MEAT_FOOD):
-			start_pos = BugWorld.get_random_location_in_world(self)
-			self.WorldObjects.append(Meat(self, start_pos, "M" + str(i)))
+	@property
+	def WorldObjects(self):
+		"""list of all of the objects in the world.  Add and remove them through self.entities"""
+		return list(self.entities)
 
 	def update(self):
-		for BWO in self.WorldObjects:
-			BWO.update(self.rel_position)
-
-		self.collisions.detect_collisions()
+		step = self.sim_step
+		think = self.scheduler.due('brains', step)
+		if self.bug_state is None:
+			for BWO in self.entities.dynamic():
+				if isinstance(BWO, Bug.Bug):
+					BWO.update(self.rel_position, think)
+				else:
+					BWO.update(self.rel_position)
+		else:
+			bugs = []
+			for BWO in self.entities.dynamic():
+				if isinstance(BWO, Bug.Bug):
+					bugs.append(BWO)
+				else:
+					BWO.update(self.rel_position)
+			Bug.Bug.update_all(bugs, self.rel_position, think)
+
+		look = self.scheduler.due('vision', step)
+		if look:  # the last thing each bug saw is kept until now, so brains that run in between still see it
+			for bug in self.entities.of_type(*self.valid_population_types):
+				bug.bi.clear_vision()
+		self.collisions.detect_collisions(skip=() if look or self.vision else (coll.Collisions.VISUAL,))
+		if self.vision and look:
+			self.vision.sense(self.entities.of_type(*self.valid_population_types))
 		self.post_collision_processing()
 
-		self.adjust_populations()
+		if self.scheduler.due('populations', step):
+			self.adjust_populations()
 		self.sim_step += 1
 
 	def draw(self, surface):
-		for BWO in self.WorldObjects:
+		for BWO in self.entities:
 			BWO.draw(surface)
 
 	def adjust_populations(self):
 		objs_to_del = []
 		objs_to_add = []
-		self.reproduction_countdown -= 1
+		self.reproduction_countdown -= self.scheduler.period('populations')  # steps since it last ran
 
-		if self.reproduction_countdown == 0:
+		if self.reproduction_countdown <= 0:
 			self.reproduction_countdown = BugWorld.NUM_STEPS_BEFORE_REPRODUCTION
 			objs_to_del, objs_to_add = self.populations.reproduce()
 
@@ -577,82 +954,93 @@ class BugWorld:  # defines the world, holds the objects, defines the rules of in
 			num_to_add = int(amt_needed/health_per_plant)
 
 			# TODO: change this to objs_to_add once returned from plant population
-			for i in range(0, num_to_add):
-				start_pos = BugWorld.get_random_location_in_world(self)
-				self.WorldObjects.append(Plant(self, start_pos, "P" + str(i)))
-
-		# Clean out all of the old bugs
-		delete_list = []
-		working_list = []
-
-		#loop through every object in the list
-		for wo in self.WorldObjects:
-			if wo in objs_to_del:  # if the objects health is gone, add it to the list of objects to delete
-				delete_list.append(wo)
-			else:  # copy the object over to the working list
-				wo.reset_fitness()  # NEAT evaluations
-				working_list.append(wo)
-
-		self.WorldObjects = working_list  # copy working list back over to the WorldObjects
-
-		# call the kill method on each object that was marked for deletion.
-		# That will deregister from collisions it and clean up from the population
-		for dl in delete_list:
-			dl.kill()
-
-		# if len(delete_list):
-		# 	temp_dl = delete_list[0]
-		# else:
-		# 	temp_dl = None
-		#
-		# for dl in delete_list:
-		# 	rc = sys.getrefcount(dl)
-		# 	print("before kill:" + str(rc))
-		# 	dl.kill()
-		# 	rc = sys.getrefcount(dl)
-		# 	print("after kill:" + str(rc))
-
-		# if temp_dl is not None:
-		# 	gc.collect()
-		# 	rc = sys.getrefcount(temp_dl)
-		# 	objgraph.show_backrefs(temp_dl, filename='temp_dl.png')
-		# 	print("after gc:" + str(rc))
-
-		# now add all of the new bugs
-		for ao in objs_to_add:
-			bug_type, genome = ao
-			new_bug = self.world_object_factory(bwo_type=bug_type, genome=genome)
-			self.WorldObjects.append(new_bug)
+			self.spawn(BWOType.PLANT, num_to_add, name="P")
+
+			# Clean out the bugs that didn't make it into the new populations
+			# call the kill method on each object that was marked for deletion.
+			# That will deregister from collisions it and clean up from the population
+			for dl in objs_to_del:
+				if dl in self.entities:
+					self.entities.remove(dl)
+					self.retire(dl)
+				elif self.dead_bugs.pop(dl.entity_id, None) is not None:
+					self.retire(dl)
+
+			# start the next generation's NEAT evaluations from scratch
+			for wo in self.entities:
+				wo.reset_fitness()
+
+		# now add all of the new bugs, a batch of each type
+		genomes = {}
+		for bug_type, genome in objs_to_add:
+			genomes.setdefault(bug_type, []).append(genome)
+		for bug_type, type_genomes in genomes.items():
+			self.spawn(bug_type, len(type_genomes), type_genomes)
 
 	def post_collision_processing(self):
-		#loop through objects and delete them, convert them etc.
+		#delete or convert the objects that died this step.  They marked themselves when their health ran out
 
-		#if health < 0, delete.
 		#if was a bug, convert it to meat
 		#if it was a plant, just delete it
 
-		delete_list = []
-		working_list = []
-
-		#loop through every object in the list
-		for wo in self.WorldObjects:
-			if wo.health <= 0:  # if the objects health is gone, add it to the list of objects to delete
-				if wo.type in {BWOType.PLANT, BWOType.MEAT}:  # let adjust_populations clean out bugs
-					delete_list.append(wo)
-
-				# if it is a bug, then add a meat object to the same location
-				if wo.type in {BWOType.HERB, BWOType.OMN, BWOType.CARN}:
-					start_pos = wo.get_rel_position()  # get location of the dead bug
-					working_list.append(Meat(self, start_pos, "M-" + wo.name)) # create a meat object at same location
-			else:  # copy the object over to the working list
-				working_list.append(wo)
-
-		self.WorldObjects = working_list  # copy working list back over to the WorldObjects
+		for wo in self.entities.take_pending():
+			self.entities.remove(wo)
+
+			# if it is a bug, then add a meat object to the same location
+			if wo.type in self.valid_population_types:
+				start_pos = wo.get_rel_position()  # get location of the dead bug
+				meat = self.world_object_factory(BWOType.MEAT, start_pos, "M-" + wo.name)  # a meat object at same location
+				self.entities.add(meat)
+				self.dead_bugs[wo.entity_id] = wo  # let adjust_populations clean out bugs
+			else:
+				# That will deregister from collisions it
+				self.retire(wo)
+
+	def retire(self, bwo):
+		"""kills an object that has been taken out of the world, or keeps it in the pool to be reused"""
+		if self.pool is not None:
+			self.pool.put(bwo)
+		else:
+			bwo.kill()
+
+	def spawn(self, bwo_type, num, genomes=None, name=None):
+		"""creates num objects of bwo_type at random places and adds them to the world.  The positions, new genomes and
+			registering with the collisions and populations are all done for the whole batch at once.
+			genomes: list of genome dictionaries for bugs, new ones are made if None
+			name: the objects are named name + a counter, the type's name if None
+			returns the new objects"""
+		if num <= 0:
+			return []
+		if name is None:
+			name = BWOType.get_name(bwo_type)
+		if genomes is None:
+			genomes = [None] * num
+			if bwo_type in self.valid_population_types:
+				genomes = self.populations.lookup_population(bwo_type).get_new_genomes(num)
+		positions = self.get_random_locations_in_world(num)
 
-		# call the kill method on each object that was marked for deletion.
-		# That will deregister from collisions it and clean up from the population
-		for dl in delete_list:
-			dl.kill()
+		self.spawning = True
+		try:
+			objs = [self.world_object_factory(bwo_type, pos, name + str(i), genome)
+					for i, (pos, genome) in enumerate(zip(positions, genomes))]
+		finally:
+			self.spawning = False
+		if objs[0] is None:  # the factory already logged it
+			return []
+
+		first = objs[0]
+		for collision_type in first.EMITS:
+			coll.CollisionInterface.register_all_as_emitters(objs, collision_type, first.STATIC)
+		for collision_type in first.DETECTS:
+			coll.CollisionInterface.register_all_as_detectors(objs, collision_type)
+		if isinstance(first, Bug.Bug):
+			self.populations.register_all(objs)
+			if self.bug_state is not None:  # so they're in the right place before they move
+				self.bug_state.place(np.array([bug._slot for bug in objs]), self.rel_position)
+
+		for obj in objs:
+			self.entities.add(obj)
+		return objs
 
 	def kill_em_all(self):  # ...and let the garbage collector sort them out.  This deletes all of the objs, collisions etc
 		#TODO implement this once you put it into the main loop
@@ -668,6 +1056,12 @@ class BugWorld:  # defines the world, holds the objects, defines the rules of in
 			name = BWOType.get_name(bwo_type)
 			#TODO add unique counter for the bug
 
+		if self.pool is not None:
+			bwo = self.pool.take(bwo_type)
+			if bwo is not None:
+				bwo.revive(starting_pos, name, genome)
+				return bwo
+
 		if bwo_type == BWOType.HERB:
 			return Herbivore(self, starting_pos, name, genome)
 		elif bwo_type == BWOType.CARN:
@@ -675,52 +1069,80 @@ class BugWorld:  # defines the world, holds the objects, defines the rules of in
 		elif bwo_type == BWOType.OMN:
 			return Omnivore(self, starting_pos, name, genome)
 		elif bwo_type == BWOType.OBST:
-			if not genome:
+			if genome:
 				logging.error("shouldn't have a genome for an obstacle")
 			return Obstacle(self, starting_pos, name)
 		elif bwo_type == BWOType.MEAT:
-			if not genome:
+			if genome:
 				logging.error("shouldn't have a genome for an meat")
 			return Meat(self, starting_pos, name)
 		elif bwo_type == BWOType.PLANT:
-			if not genome:
+			if genome:
 				logging.error("shouldn't have a genome for an plant ( yet :-} )")
 			return Plant(self, starting_pos, name)
 		else:
 			logging.error("invalid Object Type: " + str(bwo_type))
 
+	def measure_memory(self, bwo_types=MEMORY_TYPES, num=200):
+		"""returns {type name: bytes} that one more object of each type costs, everything it allocates included
+			(subcomponents, interfaces, brain, its share of the BugState arrays).  The objects are killed after"""
+		report = {}
+		food_amounts = self.global_plant_food_amount, self.global_meat_food_amount
+		pool, self.pool = self.pool, None  # reused objects would cost nothing, so build new ones
+		for bwo_type in bwo_types:
+			was_tracing = tracemalloc.is_tracing()
+			if not was_tracing:
+				tracemalloc.start()
+			before = tracemalloc.get_traced_memory()[0]
+			objs = [self.world_object_factory(bwo_type, name=BWOType.get_name(bwo_type), genome=None) for i in range(num)]
+			after = tracemalloc.get_traced_memory()[0]
+			if not was_tracing:
+				tracemalloc.stop()
+			for obj in objs:
+				obj.kill()
+			report[BWOType.get_name(bwo_type)] = (after - before) / num
+		self.pool = pool
+		self.global_plant_food_amount, self.global_meat_food_amount = food_amounts
+		return report
+
 	# ----- Utility Class Methods ----------------
 
 	def adjust_for_boundary(wt):  # adjust an inputed transform to account for world boundaries and wrap
+		# one object at a time.  BugState.apply_boundary does the same for arrays of positions
 		if BugWorld.BOUNDARY_WRAP:
-			if wt[0][3] < 0:  wt[0][3] = BugWorld.BOUNDARY_WIDTH
-			elif wt[0][3] > BugWorld.BOUNDARY_WIDTH: wt[0][3] = 0
-
-			if wt[1][3] < 0: wt[1][3] = BugWorld.BOUNDARY_HEIGHT
-			elif wt[1][3] > BugWorld.BOUNDARY_HEIGHT: wt[1][3] = 0
+			# modulo so a bug that goes over one edge comes in the other one by the same amount
+			wt.x %= BugWorld.BOUNDARY_WIDTH
+			if wt.x >= BugWorld.BOUNDARY_WIDTH: wt.x = 0  # only from a tiny negative number
+			wt.y %= BugWorld.BOUNDARY_HEIGHT
+			if wt.y >= BugWorld.BOUNDARY_HEIGHT: wt.y = 0
 		else:
-			if wt[0][3] < 0:  wt[0][3] = 0
-			elif wt[0][3] > BugWorld.BOUNDARY_WIDTH: wt[0][3] = BugWorld.BOUNDARY_WIDTH
+			if wt.x < 0:  wt.x = 0
+			elif wt.x > BugWorld.BOUNDARY_WIDTH: wt.x = BugWorld.BOUNDARY_WIDTH
 
-			if wt[1][3] < 0: wt[1][3] = 0
-			elif wt[1][3] > BugWorld.BOUNDARY_HEIGHT: wt[1][3] = BugWorld.BOUNDARY_HEIGHT
+			if wt.y < 0: wt.y = 0
+			elif wt.y > BugWorld.BOUNDARY_HEIGHT: wt.y = BugWorld.BOUNDARY_HEIGHT
 
 		return wt  # return the updated transform
 
 	def get_pos_transform(x=0, y=0, z=0, theta=0):  # utility function to encapsulate translation and rotation
 		#use this anytime a transform is needed in the world.
 		#assume the angle is measured in the x,y plane around z axis
-		#it will be an absolute transform in the local x, y, theta space
-		T = [x, y, z] #create a translation matrix
-		R = E.euler2mat( 0, 0, theta ) #create a rotation matrix around Z axis.
-		Z = [1, 1, 1] # zooms...only included because API required it... will ignore the skew
-		return AFF.compose(T, R, Z)
+		#it will be an absolute transform in the local x, y, theta space.  z is ignored, the world is flat
+		return Pose(x, y, theta)
 
 	def get_x(position):
-		return position[0][3]
+		return position.x
 
 	def get_y(position):
-		return position[1][3]
+		return position.y
+
+	def get_random_locations_in_world(self, num):
+		"""num poses spread the same way as get_random_location_in_world, drawn with one call"""
+		draws = np.random.random((num, 3))
+		x = np.floor(draws[:, 0] * (BugWorld.BOUNDARY_WIDTH + 1))
+		y = np.floor(draws[:, 1] * (BugWorld.BOUNDARY_HEIGHT + 1))
+		theta = draws[:, 2] * 2 * np.pi  # orientation in radians
+		return [BugWorld.get_pos_transform(x, y, 0, theta) for x, y, theta in zip(x.tolist(), y.tolist(), theta.tolist())]
 
 	def get_random_location_in_world(self):
 		x = random.randint(0, BugWorld.BOUNDARY_WIDTH)
@@ -732,6 +1154,8 @@ class BugWorld:  # defines the world, holds the objects, defines the rules of in
 
 # ------------- definitions of all of the objects in the world --------------------
 class Herbivore(Bug.Bug):
+	__slots__ = ()
+
 	def __init__(self, bug_world, starting_pos, name="HERB", genome=None):
 		super().__init__(bug_world, starting_pos, name, genome, bug_type=BWOType.HERB )
 		self.color = Color.GREEN
@@ -739,6 +1163,8 @@ class Herbivore(Bug.Bug):
 
 
 class Omnivore(Bug.Bug):
+	__slots__ = ()
+
 	def __init__(self, bug_world, starting_pos, name="OMN", genome=None):
 		super().__init__(bug_world, starting_pos, name, genome, bug_type=BWOType.OMN )
 		self.color = Color.ORANGE
@@ -746,52 +1172,84 @@ class Omnivore(Bug.Bug):
 
 
 class Carnivore(Bug.Bug):
+	__slots__ = ()
+
 	def __init__(self, bug_world, starting_pos, name="CARN", genome=None):
 		super().__init__(bug_world, starting_pos, name, genome, bug_type=BWOType.CARN)
 		self.color = Color.RED
 		self.default_color = self.color
 
 
-class Obstacle(BWObject):
+class Obstacle(StaticBWObject):
+	__slots__ = ()
+
+	EMITS = (coll.Collisions.PHYSICAL, coll.Collisions.VISUAL)
+
 	def __init__ (self, bug_world, starting_pos, name="OBST"):
 		super().__init__(bug_world, starting_pos, name )
 		self.color = Color.YELLOW
 		self.default_color = self.color
 		self.type = BWOType.OBST
+		self.ci = coll.CollisionInterface(bug_world.collisions, self)
+		self.revive(starting_pos, name)
+
+	def revive(self, starting_pos, name, genome=None):
+		"""sets it up as a new obstacle.  Also used when it comes back out of the EntityPool"""
+		self.rel_position = starting_pos
+		self.name = name
+		self.color = self.default_color
 		self.size = 7
 		self.health = 100
-		self.ci = coll.CollisionInterface(bug_world.collisions, self)
-		self.ci.register_as_emitter(self, coll.Collisions.PHYSICAL)
-		self.ci.register_as_emitter(self, coll.Collisions.VISUAL)
+		self.register_collisions()
+
+
+class Meat(StaticBWObject):
+	__slots__ = ()
 
+	EMITS = (coll.Collisions.PHYSICAL, coll.Collisions.VISUAL)
 
-class Meat(BWObject):
 	def __init__ (self, bug_world, starting_pos, name ="MEAT"):
 		super().__init__(bug_world, starting_pos, name )
 		self.color = Color.BROWN
 		self.default_color = self.color
 		self.type = BWOType.MEAT
+		self.ci = coll.CollisionInterface(bug_world.collisions, self)
+		self.revive(starting_pos, name)
+
+	def revive(self, starting_pos, name, genome=None):
+		"""sets it up as new meat.  Also used when it comes back out of the EntityPool"""
+		self.rel_position = starting_pos
+		self.name = name
+		self.color = self.default_color
 		self.size = 10
 		self.health = 100
-		self.ci = coll.CollisionInterface(bug_world.collisions, self)
-		self.ci.register_as_emitter(self, coll.Collisions.PHYSICAL)
-		self.ci.register_as_emitter(self, coll.Collisions.VISUAL)
-		self.bug_world.global_plant_meat_amount += self.health
+		self.register_collisions()
+		self.bug_world.global_meat_food_amount += self.health
+
 
 
+class Plant(StaticBWObject):
+	__slots__ = ()
+
+	EMITS = (coll.Collisions.PHYSICAL, coll.Collisions.VISUAL)
 
-class Plant(BWObject):
 	def __init__(self, bug_world, starting_pos, name="PLANT"):
 		super().__init__(bug_world, starting_pos, name )
 		# self.color = Color.DARK_GREEN
 		self.color = Color.RED
 		self.default_color = self.color
 		self.type = BWOType.PLANT
+		self.ci = coll.CollisionInterface(bug_world.collisions, self)
+		self.revive(starting_pos, name)
+
+	def revive(self, starting_pos, name, genome=None):
+		"""sets it up as a new plant.  Also used when it comes back out of the EntityPool"""
+		self.rel_position = starting_pos
+		self.name = name
+		self.color = self.default_color
 		self.size = 5
 		self.health = 100
-		self.ci = coll.CollisionInterface(bug_world.collisions, self)
-		self.ci.register_as_emitter(self, coll.Collisions.PHYSICAL)
-		self.ci.register_as_emitter(self, coll.Collisions.VISUAL)
+		self.register_collisions()
 		self.bug_world.global_plant_food_amount += self.health
 
 
@@ -1,4 +1,12 @@
 import logging
+import random
+import numpy as np
+from itertools import chain, count
+
+try:  # only needed for the KD-tree broad phase
+	from scipy.spatial import cKDTree
+except ImportError:
+	cKDTree = None
 
 logger = logging.getLogger()
 logger.setLevel(logging.ERROR)
@@ -28,37 +36,75 @@ class CollisionInterface:
 	_emitter = 'emitter'
 	_detector = 'detector'
 
+	__slots__ = ('collisions', 'collision_registration_list', 'owner')  # every object has one, so keep it small
+
 	def __init__(self, collisions, owner):
 		self.collisions = collisions  #the container for all collisions
 		self.collision_registration_list = []  # this holds all of the registrations an object has registered for
 		self.owner = owner  # This is the ultimate owner of all of the sub-components...very top of hierarchy
 
-	def register_as_emitter(self, collision_object, collision_type):
+	def register_as_emitter(self, collision_object, collision_type, static=False):
+		"""static: True if the object doesn't move by itself.  Static emitters are kept in an index that is only
+			rebuilt when one is added or removed, so call static_changed if one is moved or resized"""
 		if collision_type not in self.collisions.valid_types:
 			logging.error("Unsupported collision type: ", collision_type)
 			return
 		else:
-			self.collisions.register_emitter(collision_object, collision_type)
-			self.collision_registration_list.append((collision_object, collision_type, self._emitter))
+			handle = self.collisions.register_emitter(collision_object, collision_type, static)
+			self.collision_registration_list.append((collision_object, collision_type, self._emitter, handle))
 
 	def register_as_detector(self, collision_object, collision_type):
 		if collision_type not in self.collisions.valid_types:
 			logging.error("Unsupported collision type: ", collision_type)
 			return
 		else:
-			self.collisions.register_detector(collision_object, collision_type)
-			self.collision_registration_list.append((collision_object, collision_type, self._detector))
+			handle = self.collisions.register_detector(collision_object, collision_type)
+			self.collision_registration_list.append((collision_object, collision_type, self._detector, handle))
+
+	@classmethod
+	def register_all_as_emitters(cls, collision_objects, collision_type, static=False):
+		"""same as co.ci.register_as_emitter(co, collision_type, static) for each object but the whole batch is added
+			in one go.  They must all be in the same Collisions"""
+		cls.register_all(collision_objects, collision_type, cls._emitter, static)
+
+	@classmethod
+	def register_all_as_detectors(cls, collision_objects, collision_type):
+		cls.register_all(collision_objects, collision_type, cls._detector)
+
+	@classmethod
+	def register_all(cls, collision_objects, collision_type, emitter_or_detector, static=False):
+		if not collision_objects:
+			return
+		collisions = collision_objects[0].ci.collisions
+		if collision_type not in collisions.valid_types:
+			logging.error("Unsupported collision type: ", collision_type)
+			return
+		if emitter_or_detector == cls._emitter:
+			handles = collisions.register_emitters(collision_objects, collision_type, static)
+		else:
+			handles = collisions.register_detectors(collision_objects, collision_type)
+		for collision_object, handle in zip(collision_objects, handles):
+			collision_object.ci.collision_registration_list.append((collision_object, collision_type, emitter_or_detector, handle))
 
-	def deregister_all(self):
-		for collision_object, collision_type, emitter_or_detector in self.collision_registration_list:
+	def deregister_all(self, keep=False):
+		"""keep: True if the interface will be registered again (e.g., the object is going into a pool)"""
+		for collision_object, collision_type, emitter_or_detector, handle in self.collision_registration_list:
 			if emitter_or_detector == self._emitter:
-				self.collisions.deregister_emitter(collision_object, collision_type)
+				self.collisions.deregister_emitter(handle, collision_type)
 			else:
-				self.collisions.deregister_detector(collision_object, collision_type)
+				self.collisions.deregister_detector(handle, collision_type)
 
 		self.collision_registration_list.clear()
-		self.collisions = None
-		self.owner = None
+		if not keep:
+			self.collisions = None
+			self.owner = None
+
+	def static_changed(self, rebuild=True):
+		"""tell the collision system a static emitter moved or changed size.  rebuild=False if it only got smaller,
+			then the index is patched instead of rebuilt"""
+		for collision_object, collision_type, emitter_or_detector, handle in self.collision_registration_list:
+			if emitter_or_detector == self._emitter:
+				self.collisions.static_emitter_changed(handle, collision_type, rebuild)
 
 	def is_this_me(self, co2):
 		if self.owner == co2.ci.owner:
@@ -67,18 +113,450 @@ class CollisionInterface:
 			return False
 
 
+class RegistrationList:
+	"""A dense list of registered objects.  add() returns a handle that stays valid until the object is removed.
+		remove() moves the last object into the freed slot, so adding and removing are both O(1)
+		but the order of the list is not preserved"""
+
+	def __init__(self, handles=None):
+		"""handles: optional counter to take handles from, so lists sharing it never hand out the same one"""
+		self._objects = []
+		self._handles = []  # handle of the object in the same slot of _objects
+		self._slots = {}  # handle -> slot the object is currently in
+		self._next_handle = handles if handles is not None else count()
+		self.version = 0  # changes every time an object is added or removed, so callers can tell if slots moved
+
+	def __len__(self):
+		return len(self._objects)
+
+	def __iter__(self):
+		return iter(self._objects)
+
+	def __getitem__(self, slot):
+		return self._objects[slot]
+
+	def handles(self):
+		"""copy of the handles in slot order"""
+		return list(self._handles)
+
+	def has_handle(self, handle):
+		return handle in self._slots
+
+	def get(self, handle):
+		return self._objects[self._slots[handle]]
+
+	def touch(self):
+		"""changes the version without adding or removing, e.g., when an object changed in a way callers cache"""
+		self.version += 1
+
+	def add(self, obj):
+		self.version += 1
+		handle = next(self._next_handle)
+		self._slots[handle] = len(self._objects)
+		self._objects.append(obj)
+		self._handles.append(handle)
+		return handle
+
+	def add_all(self, objs):
+		"""same as add for each object, returns their handles"""
+		self.version += 1
+		start = len(self._objects)
+		handles = [next(self._next_handle) for obj in objs]
+		self._slots.update(zip(handles, range(start, start + len(handles))))
+		self._objects.extend(objs)
+		self._handles.extend(handles)
+		return handles
+
+	def remove(self, handle):
+		slot = self._slots.pop(handle, None)
+		if slot is None:
+			logging.warning("handle is not registered: " + str(handle))
+			return
+
+		self.version += 1
+		last_obj = self._objects.pop()
+		last_handle = self._handles.pop()
+		if slot < len(self._objects):  # fill the hole with the object that was at the end
+			self._objects[slot] = last_obj
+			self._handles[slot] = last_handle
+			self._slots[last_handle] = slot
+
+
+class BroadPhase:
+	"""Base class for the broad phase strategies.  A broad phase cheaply picks the (detector, emitter) pairs
+		that might overlap so the exact circle test only runs on those.  It can return extra pairs, never fewer.
+
+		build() indexes the emitters once, then query() can be called for any number of detector sets.
+		det and em are the tuples of arrays from gather_geometry"""
+
+	def __init__(self, bounds=None, wrap=False):
+		""" bounds: (width, height) of the world
+			wrap: True if the edges of the world are joined """
+		self._bounds = bounds
+		self._wrap = wrap and bounds is not None
+		self._emitters_version = None
+		self.candidate_pairs = 0  # count of pairs produced since the start of the detection
+
+	def start_detection(self, emitters_version):
+		"""called before each detection.
+			emitters_version changes whenever an emitter is added or removed, i.e., when the slots have moved"""
+		self._emitters_version = emitters_version
+		self.candidate_pairs = 0
+
+	def find_pairs(self, det, em, partition=None):
+		"""builds the index and queries it in one go.  returns candidate (detector, emitter) index arrays.
+			partition: identifies which subset of the emitters is passed if a group makes more than one call"""
+		self.build(em, det[2].max(), partition)
+		return self.query(det)
+
+	def build(self, em, reach, partition=None):
+		"""index the emitters.  reach is the biggest detector radius that will be queried"""
+		self._em = em
+		self._reach = reach
+		self._em_r_max = em[2].max()
+		self.build_index(partition)
+
+	def query(self, det):
+		"""returns candidate (detector, emitter) index arrays for the emitters passed to build"""
+		det_idx, em_idx = self.candidates(det)
+		self.candidate_pairs += len(det_idx)
+		return det_idx, em_idx
+
+	def build_index(self, partition):  # override if the strategy has an index
+		pass
+
+	def candidates(self, det):  # must be overwritten
+		raise NotImplementedError
+
+
+class BruteForceBroadPhase(BroadPhase):
+	"""pairs every detector with every emitter.  Slow but obviously right, so use it to validate the others"""
+
+	def candidates(self, det):
+		return all_pairs(len(det[0]), len(self._em[0]))
+
+
+class UniformGridBroadPhase(BroadPhase):
+	"""buckets the emitters in a uniform grid and pairs each detector with the emitters in its own cell and
+		the neighbouring ones.  If the world wraps, the cells on opposite edges are neighbours"""
+
+	def build_index(self, partition):
+		em_x, em_y = self._em[:2]
+
+		# two circles can only touch if their centers are closer than the sum of their radii.
+		# making a cell at least that wide means a collision can never skip over a neighbouring cell
+		cell_size = max(self._reach + self._em_r_max, 1)
+		self.grid_dimensions(cell_size)
+		if self._too_small:
+			return
+
+		em_col, em_row = self.cell_coords(em_x, em_y)
+		if not self._wrap:  # unbounded grid, so size it to fit the emitters
+			self._min_col = em_col.min()
+			self._min_row = em_row.min()
+			em_col = em_col - self._min_col
+			em_row = em_row - self._min_row
+			self._cols = em_col.max() + 1
+			self._rows = em_row.max() + 1
+
+		# sort the emitters by cell so each cell is a contiguous range that can be found with a binary search
+		em_cell = em_col * self._rows + em_row
+		self._em_order = np.argsort(em_cell, kind='stable')
+		self._sorted_cells = em_cell[self._em_order]
+
+	def candidates(self, det):
+		det_x, det_y = det[:2]
+		if self._too_small:  # the neighbours wrap onto each other so the grid can't prune anything
+			return all_pairs(len(det_x), len(self._em[0]))
+
+		det_col, det_row = self.cell_coords(det_x, det_y)
+		if not self._wrap:
+			det_col = det_col - self._min_col
+			det_row = det_row - self._min_row
+
+		det_parts = []
+		em_parts = []
+		for dc in (-1, 0, 1):
+			for dr in (-1, 0, 1):
+				col = det_col + dc
+				row = det_row + dr
+				if self._wrap:
+					col %= self._cols
+					row %= self._rows
+					cell = col * self._rows + row
+				else:  # cells off the edge of the grid have no emitters
+					valid = (col >= 0) & (col < self._cols) & (row >= 0) & (row < self._rows)
+					cell = np.where(valid, col * self._rows + row, -1)
+				start = np.searchsorted(self._sorted_cells, cell, 'left')
+				counts = np.searchsorted(self._sorted_cells, cell, 'right') - start
+				det_parts.append(np.repeat(np.arange(len(det_x)), counts))
+				em_parts.append(self._em_order[expand_ranges(start, counts)])
+
+		return np.concatenate(det_parts), np.concatenate(em_parts)
+
+	def grid_dimensions(self, cell_size):
+		self._too_small = False
+		if not self._wrap:
+			self._cell_w = self._cell_h = cell_size
+			return
+
+		# stretch the cells so a whole number of them covers the world and the last column touches the first
+		width, height = self._bounds
+		self._cols = max(1, int(width // cell_size))
+		self._rows = max(1, int(height // cell_size))
+		self._cell_w = width / self._cols
+		self._cell_h = height / self._rows
+		self._too_small = self._cols < 3 or self._rows < 3
+
+	def cell_coords(self, x, y):
+		col = np.floor(x / self._cell_w).astype(np.int64)
+		row = np.floor(y / self._cell_h).astype(np.int64)
+		if self._wrap:  # objects that hang over an edge are wrapped back into the world
+			col %= self._cols
+			row %= self._rows
+		return col, row
+
+
+class SweepAndPruneBroadPhase(BroadPhase):
+	"""sorts the emitters by where they start along x and sweeps each detector's x interval over them.
+		Pairs whose intervals don't overlap in x or y are pruned.
+
+		Objects only move a little each step, so the order is kept between steps and used as the starting point
+		for the next sort"""
+
+	def __init__(self, bounds=None, wrap=False):
+		super().__init__(bounds, wrap)
+		self._orders = {}  # partition -> (emitters version, order of the emitters along x last step)
+
+	def build_index(self, partition):
+		em_x, em_y, em_r = self._em[:3]
+		em_start = em_x - em_r
+		self._em_order = self.sort_order(em_start, partition)
+		self._sorted_start = em_start[self._em_order]
+
+	def candidates(self, det):
+		det_x, det_y, det_r = det[:3]
+		em_x, em_y, em_r = self._em[:3]
+
+		# an emitter can only overlap if it starts before the detector ends, and it can't start more than
+		# the widest emitter's diameter before the detector starts
+		lo = np.searchsorted(self._sorted_start, det_x - det_r - 2 * self._em_r_max, 'left')
+		hi = np.searchsorted(self._sorted_start, det_x + det_r, 'left')
+		counts = hi - lo
+		det_idx = np.repeat(np.arange(len(det_x)), counts)
+		em_idx = self._em_order[expand_ranges(lo, counts)]
+
+		overlap = em_x[em_idx] + em_r[em_idx] > det_x[det_idx] - det_r[det_idx]
+		overlap &= np.abs(em_y[em_idx] - det_y[det_idx]) < em_r[em_idx] + det_r[det_idx]
+		return det_idx[overlap], em_idx[overlap]
+
+	def sort_order(self, em_start, partition):
+		last_version, last_order = self._orders.get(partition, (None, None))
+
+		if last_version == self._emitters_version and len(last_order) == len(em_start):
+			# same emitters in the same slots as last step, so last step's order is nearly sorted.
+			# a stable sort is a timsort, which like an insertion sort is close to linear on nearly sorted data
+			order = last_order[np.argsort(em_start[last_order], kind='stable')]
+		else:  # something was added or removed so start from scratch
+			order = np.argsort(em_start, kind='stable')
+
+		self._orders[partition] = (self._emitters_version, order)
+		return order
+
+
+class KDTreeBroadPhase(BroadPhase):
+	"""puts the emitters in a scipy KD-tree and asks it for every emitter within reach of each detector.
+		Falls back to the uniform grid if scipy isn't installed"""
+
+	def __init__(self, bounds=None, wrap=False):
+		super().__init__(bounds, wrap)
+		self._fallback = None
+		if cKDTree is None:
+			logging.error("scipy is not installed, using the uniform grid instead of the KD-tree")
+			self._fallback = UniformGridBroadPhase(bounds, wrap)
+
+	def build_index(self, partition):
+		if self._fallback is not None:
+			self._fallback.build(self._em, self._reach, partition)
+			return
+
+		em_x, em_y = self._em[:2]
+		self._tree = cKDTree(np.column_stack((em_x, em_y)))
+
+	def candidates(self, det):
+		if self._fallback is not None:
+			return self._fallback.candidates(det)
+
+		det_x, det_y, det_r = det[:3]
+
+		# the centers can't be further apart than the detector's radius plus the biggest emitter's radius
+		neighbours = self._tree.query_ball_point(np.column_stack((det_x, det_y)), det_r + self._em_r_max)
+
+		counts = np.fromiter((len(n) for n in neighbours), dtype=np.int64, count=len(neighbours))
+		det_idx = np.repeat(np.arange(len(det_x)), counts)
+		em_idx = np.fromiter(chain.from_iterable(neighbours), dtype=np.int64, count=counts.sum())
+		return det_idx, em_idx
+
+
+class StaticGeometry:
+	"""The static emitters of every group, gathered and indexed once.  Kept by StaticLayer until a static emitter
+		is added, removed or changed"""
+
+	def __init__(self, collision_groups, broad_phase, versions, reach):
+		self.versions = versions
+		self.reach = reach
+		self.slots = {}  # id(object) -> slot in the static arrays
+		self.group_slots = {}  # id(group) -> slots of the group's static emitters, in the group's order
+		objects = []
+		for group in collision_groups:
+			group_slots = []
+			for co in group._static_emitters:
+				slot = self.slots.get(id(co))
+				if slot is None:
+					slot = self.slots[id(co)] = len(objects)
+					objects.append(co)
+				group_slots.append(slot)
+			self.group_slots[id(group)] = np.array(group_slots, dtype=np.int64)
+
+		self.objects = objects
+		self.geometry = gather_geometry(objects)
+		self.types = np.array([co.type for co in objects], dtype=np.int64)
+
+		self._broad_phase = broad_phase
+		if objects:
+			# the index gets its own copy so patch() can't change it underneath it
+			broad_phase.start_detection(versions)
+			broad_phase.build(tuple(array.copy() for array in self.geometry), reach, 'static')
+
+	def patch(self, collision_object):
+		"""takes the new size of a static emitter that shrank.  The index still has it at its old size, which only
+			means it hands out a few pairs that don't touch"""
+		slot = self.slots.get(id(collision_object))
+		if slot is not None:
+			self.geometry[2][slot] = collision_object.get_size()
+
+	def query(self, det):
+		"""returns candidate pairs as (index into det, static slot)"""
+		if not self.objects:
+			return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+		return self._broad_phase.query(det)
+
+
+class StaticLayer:
+	"""keeps the StaticGeometry from step to step and only rebuilds it when it is out of date"""
+
+	def __init__(self, broad_phase):
+		self._broad_phase = broad_phase
+		self._geometry = None
+		self.rebuilds = 0
+
+	def patch(self, collision_object):
+		if self._geometry is not None:
+			self._geometry.patch(collision_object)
+
+	def get(self, collision_groups, reach):
+		versions = tuple((id(group), group._static_emitters.version) for group in collision_groups)
+		geometry = self._geometry
+		if geometry is None or geometry.versions != versions or geometry.reach < reach:
+			# leave some room so detectors that grow a little don't rebuild it every step
+			self._geometry = geometry = StaticGeometry(collision_groups, self._broad_phase, versions, reach * 1.25)
+			self.rebuilds += 1
+		return geometry
+
+
+class SharedGeometry:
+	"""Everything registered in any collision group, gathered once per step, and one broad phase index over all
+		of the emitters.  An object registered in several groups (e.g., a bug body is a physical emitter, a
+		physical detector and a visual emitter) is only gathered once.
+		Static emitters come from the StaticLayer instead and go after everything else in the arrays"""
+
+	def __init__(self, collision_groups, broad_phase, static_layer):
+		self.slots = {}  # id(object) -> slot in the shared arrays
+		objects = []
+		is_emitter = []
+		for group in collision_groups:
+			for collision_objects, emitting in ((group._emitters, True), (group._detectors, False)):
+				for co in collision_objects:
+					slot = self.slots.get(id(co))
+					if slot is None:
+						self.slots[id(co)] = len(objects)
+						objects.append(co)
+						is_emitter.append(emitting)
+					elif emitting:
+						is_emitter[slot] = True
+
+		geometry = gather_geometry(objects)
+		self.emitter_slots = np.flatnonzero(np.array(is_emitter, dtype=bool))
+
+		self._broad_phase = broad_phase
+		# the cells etc. are sized for the biggest object in any group
+		reach = geometry[2].max() if objects else 0.0
+		if len(self.emitter_slots):
+			broad_phase.build(select_geometry(geometry, self.emitter_slots), reach)
+
+		self.static = static_layer.get(collision_groups, reach)
+		self.num_dynamic = len(objects)
+		self.objects = objects + self.static.objects
+		self.geometry = tuple(np.concatenate(arrays) for arrays in zip(geometry, self.static.geometry))
+		self.types = np.concatenate((np.array([co.type for co in objects], dtype=np.int64), self.static.types))
+
+	def lookup_slots(self, collision_objects):
+		return np.array([self.slots[id(co)] for co in collision_objects], dtype=np.int64)
+
+	def lookup_emitter_slots(self, group):
+		"""shared slots of the group's emitters, in the same order as group.emitter_list()"""
+		static_slots = self.static.group_slots[id(group)] + self.num_dynamic
+		return np.concatenate((self.lookup_slots(group._emitters), static_slots))
+
+	def query(self, det_slots):
+		"""returns candidate pairs as (index into det_slots, shared slot of the emitter)"""
+		det = select_geometry(self.geometry, det_slots)
+		if len(self.emitter_slots):
+			det_idx, em_idx = self._broad_phase.query(det)
+			em_slot = self.emitter_slots[em_idx]
+		else:
+			det_idx = em_slot = np.empty(0, dtype=np.int64)
+
+		static_det_idx, static_slot = self.static.query(det)
+		if len(static_det_idx):
+			det_idx = np.concatenate((det_idx, static_det_idx))
+			em_slot = np.concatenate((em_slot, static_slot + self.num_dynamic))
+		return det_idx, em_slot
+
+
 class CollisionGroup:
 	"""A group is all of the emmitters and detectors for a particular sensor (i.e., type) e.g., physical or visual"""
 
-	def __init__(self, handler_method):
-		""" handler_method is the method to call when a detector collides with an emitter """
-		self._emitters = []
-		self._detectors = []
+	def __init__(self, handler_method, bounds=None, wrap=False, broad_phase=None):
+		""" handler_method is the method to call when a detector collides with an emitter
+			bounds: (width, height) of the world.  Only needed if wrap is used
+			wrap: if True, the edges of the world are joined (toroidal)
+			broad_phase: a BroadPhase class used to pick candidate pairs.  Defaults to UniformGridBroadPhase """
+		handles = count()  # shared so a handle says which emitter list it is in
+		self._emitters = RegistrationList(handles)  # the emitters that move
+		self._static_emitters = RegistrationList(handles)
+		self._static_geometry = (None, None)  # (static emitters version, geometry) for when the group gathers its own
+		self._detectors = RegistrationList()
 		self._enabled = True  # can be used to ignore a certain type of collisions
 		self._cb = handler_method
+		self._bounds = bounds
+		self._wrap = wrap
+		self._broad_phase = None
+		self.set_broad_phase(broad_phase or UniformGridBroadPhase)
+		self._interests = None  # detector type -> emitter types that have a handler.  None means test everything
+		self._nearest = None  # if set, the handler only gets this many of the closest emitters for each detector
+		self._batch = False  # if True, the handler gets all of the hits at once
+		self._on_enter = None  # contact handlers.  Contacts are only tracked if these are set
+		self._on_exit = None
+		self._contacts = {}  # (detector handle, emitter handle) -> (detector, emitter) for pairs touching last step
+		self._candidate_pairs = 0
 
 	def __repr__(self):
-		return 'Emitters(' + str(len(self._emitters)) + '): ' + ' '.join(map(str, self._emitters )) + '\n' + 'Detectors: ' + ' '.join(map(str, self._detectors))
+		emitters = self.emitter_list()
+		return 'Emitters(' + str(len(emitters)) + '): ' + ' '.join(map(str, emitters)) + '\n' + 'Detectors: ' + ' '.join(map(str, self._detectors))
+
+	def is_enabled(self):
+		return self._enabled
 
 	def enable_collisions(self):
 		""" Sets a state such that the collisions of this group will be checked """
@@ -88,75 +566,391 @@ class CollisionGroup:
 		""" Sets a state such that the collisions of this group will be checked """
 		self._enabled = False
 
-	def set_handler(self, handler):
+	def set_handler(self, handler, handled_pairs=None, nearest=None, batch=False):
+		"""handled_pairs: (detector type, emitter type) pairs the handler does something with.
+			If given, all other pairs are skipped before any distance is calculated
+			nearest: if None, handler(detector, emitter, dist_sqrd) is called for every overlap.
+			Otherwise handler(detector, hits) is called once per detector where hits is a list of
+			up to nearest (emitter, dist_sqrd) tuples, closest first.
+			batch: if True, handler(detectors, emitters, det_idx, em_idx, dist_sqrd) is called once per step
+			where det_idx[n] and em_idx[n] index the n-th hit in the detectors and emitters lists.
+			dist_sqrd is the squared distance between the centers, so handlers don't need to work it out again"""
 		self._cb = handler
+		self._nearest = nearest
+		self._batch = batch
+
+		if handled_pairs is None:
+			self._interests = None
+			return
+
+		interests = {}
+		for detector_type, emitter_type in handled_pairs:
+			interests.setdefault(detector_type, []).append(emitter_type)
+		self._interests = {detector_type: np.array(emitter_types) for detector_type, emitter_types in interests.items()}
+
+	def set_contact_handlers(self, on_enter, on_exit):
+		"""on_enter(detector, emitter) is called the first step a pair overlaps and on_exit(detector, emitter)
+			the first step they no longer do.  The regular handler is still called every step they overlap.
+			Exits are not reported for objects that have been deregistered"""
+		self._on_enter = on_enter
+		self._on_exit = on_exit
+		self._contacts = {}
+
+	def set_broad_phase(self, broad_phase):
+		"""broad_phase: a BroadPhase class.  Each group gets its own instance so backends can keep state"""
+		if not is_broad_phase(broad_phase):
+			return
+		self._broad_phase = broad_phase(self._bounds, self._wrap)
 
-	def add_emitter(self, collision_object):
-		self._emitters.append(collision_object)
+	def get_candidate_pairs(self):
+		"""number of candidate pairs the broad phase produced for this group during the last detection"""
+		return self._candidate_pairs
+
+	def add_emitter(self, collision_object, static=False):
+		"""returns a handle that is used to remove the emitter.  static: see CollisionInterface.register_as_emitter"""
+		if static:
+			return self._static_emitters.add(collision_object)
+		return self._emitters.add(collision_object)
 
 	def add_detector(self, collision_object):
-		self._detectors.append(collision_object)
+		"""returns a handle that is used to remove the detector"""
+		return self._detectors.add(collision_object)
+
+	def add_emitters(self, collision_objects, static=False):
+		"""returns the handles of the emitters"""
+		if static:
+			return self._static_emitters.add_all(collision_objects)
+		return self._emitters.add_all(collision_objects)
 
-	def del_emitter(self, collision_object):
-		#find object in list and remove it
+	def add_detectors(self, collision_objects):
+		return self._detectors.add_all(collision_objects)
+
+	def del_emitter(self, handle):
 		#should be called in the destructor method so that it is removed from all lists
-		#See article: https://stackoverflow.com/questions/1207406/how-to-remove-items-from-a-list-while-iterating
-		#somelist[:] = [x for x in somelist if not determine(x)]
-		self._emitters = [co for co in self._emitters if not co == collision_object]
+		if self._static_emitters.has_handle(handle):
+			self._static_emitters.remove(handle)
+		else:
+			self._emitters.remove(handle)
+
+	def static_emitter_changed(self, handle, rebuild=True):
+		"""returns the static emitter, or None if handle isn't one"""
+		if not self._static_emitters.has_handle(handle):
+			return None
+		self._static_geometry = (None, None)
+		if rebuild:
+			self._static_emitters.touch()
+		return self._static_emitters.get(handle)
+
+	def emitter_list(self):
+		"""all of the emitters, the ones that move then the static ones.  Hits index into this"""
+		return list(self._emitters) + list(self._static_emitters)
+
+	def emitter_handles(self):
+		return self._emitters.handles() + self._static_emitters.handles()
+
+	def has_emitter(self, handle):
+		return self._emitters.has_handle(handle) or self._static_emitters.has_handle(handle)
+
+	def emitters_version(self):
+		return self._emitters.version, self._static_emitters.version
+
+	def gather_emitters(self):
+		"""geometry of emitter_list().  The static part is only gathered again after it changed"""
+		version, static_geometry = self._static_geometry
+		if version != self._static_emitters.version:
+			static_geometry = gather_geometry(list(self._static_emitters))
+			self._static_geometry = (self._static_emitters.version, static_geometry)
+		return tuple(np.concatenate(arrays) for arrays in zip(gather_geometry(list(self._emitters)), static_geometry))
+
+	def del_detector(self, handle):
+		self._detectors.remove(handle)
+
+	def detect_collisions(self, shared=None):
+		"""shared: the SharedGeometry gathered by Collisions for every group this step.
+			If None, the group gathers its own and uses its own broad phase"""
+		if not self._enabled:
+			return
+
+		# take a copy so a handler can deregister objects without moving the slots out from under the hits
+		detectors = list(self._detectors)
+		emitters = self.emitter_list()
 
-	def del_detector(self, collision_object):
-		self._detectors = [co for co in self._detectors if not co == collision_object]
+		if not detectors or not emitters:
+			det_idx = em_idx = np.empty(0, dtype=np.int64)
+			dist_sqrd = np.empty(0)
+			self._candidate_pairs = 0
+		elif shared is not None:
+			det_idx, em_idx, dist_sqrd = self.find_shared_collisions(shared, detectors, emitters)
+		else:
+			# gather everything once per step so the distance tests are done as array operations
+			det = gather_geometry(detectors)
+			em = self.gather_emitters()
+			self._broad_phase.start_detection(self.emitters_version())
 
-	def circle_collision(self, co1, co2):
-		"""takes two objects presumed to have a center and a size circle."""
+			if self._interests is None:
+				det_idx, em_idx, dist_sqrd = self.find_collisions(det, em)
+			else:
+				det_idx, em_idx, dist_sqrd = self.find_collisions_by_type(detectors, emitters, det, em)
+			self._candidate_pairs = self._broad_phase.candidate_pairs
 
-		dx = co1.get_abs_x() - co2.get_abs_x()
-		dy = co1.get_abs_y() - co2.get_abs_y()
+		if self._on_enter is not None or self._on_exit is not None:
+			self.update_contacts(detectors, emitters, det_idx, em_idx)
 
-		dist_sqrd = (dx * dx) + (dy * dy)
+		if len(det_idx) == 0:
+			return
 
-		#size is assummed to be the radius of object's circular hit box
-		if dist_sqrd < (co1.get_size() + co2.get_size())**2:
-			return True
-		else:
-			return False
+		if self._nearest is not None:
+			self.report_nearest(detectors, emitters, det_idx, em_idx, dist_sqrd)
+			return
 
-	def detect_collisions(self):
-		if not self._enabled:
+		if self._batch:
+			self._cb(detectors, emitters, det_idx, em_idx, dist_sqrd)
 			return
 
-		#loop through solid bodies
 		#call collision handlers on each object
-		for co1 in self._detectors:
-			for co2 in self._emitters:
-				if co1.ci.is_this_me(co2):
-					continue #make sure the object is not part of the bug that owns it
-				elif self.circle_collision(co1, co2):
-					logging.debug("Detector: " + co1.name + " detected Emitter:" + co2.name )
-					self._cb(co1, co2) #call the callback handler
+		for i, j, d in zip(det_idx.tolist(), em_idx.tolist(), dist_sqrd.tolist()):
+			co1 = detectors[i]
+			co2 = emitters[j]
+			logging.debug("Detector: " + co1.name + " detected Emitter:" + co2.name )
+			self._cb(co1, co2, d) #call the callback handler
+
+	def update_contacts(self, detectors, emitters, det_idx, em_idx):
+		"""compares this step's overlaps with last step's and calls the enter and exit handlers"""
+		det_handles = self._detectors.handles()
+		em_handles = self.emitter_handles()
+
+		contacts = {}
+		for i, j in zip(det_idx.tolist(), em_idx.tolist()):
+			contacts[(det_handles[i], em_handles[j])] = (detectors[i], emitters[j])
+
+		last_contacts = self._contacts
+		self._contacts = contacts
+
+		if self._on_enter is not None:
+			for key in contacts.keys() - last_contacts.keys():
+				self._on_enter(*contacts[key])
+
+		if self._on_exit is not None:
+			for key in last_contacts.keys() - contacts.keys():
+				det_handle, em_handle = key
+				if self._detectors.has_handle(det_handle) and self.has_emitter(em_handle):
+					self._on_exit(*last_contacts[key])
+
+	def report_nearest(self, detectors, emitters, det_idx, em_idx, dist_sqrd):
+		"""calls the handler once for each detector with its closest emitters"""
+		# sort by detector then by distance, then keep the first few of each detector
+		order = np.lexsort((dist_sqrd, det_idx))
+		det_idx, em_idx, dist_sqrd = det_idx[order], em_idx[order], dist_sqrd[order]
+		starts = np.flatnonzero(np.r_[True, det_idx[1:] != det_idx[:-1]])
+		rank = np.arange(len(det_idx)) - np.repeat(starts, np.diff(np.r_[starts, len(det_idx)]))
+		keep = rank < self._nearest
+		det_list = det_idx[keep].tolist()
+		em_list = em_idx[keep].tolist()
+		dist_list = dist_sqrd[keep].tolist()
+
+		hits = []
+		last = len(det_list) - 1
+		for n, i in enumerate(det_list):
+			hits.append((emitters[em_list[n]], dist_list[n]))
+			if n == last or det_list[n + 1] != i:  # that was the last hit for this detector
+				self._cb(detectors[i], hits)
+				hits = []
+
+	def find_collisions(self, det, em, partition=None):
+		"""returns the (detector, emitter) indices and squared distance of every overlapping pair"""
+		det_idx, em_idx = self._broad_phase.find_pairs(det, em, partition)
+		return self.circle_collisions(det, em, det_idx, em_idx)
+
+	def find_shared_collisions(self, shared, detectors, emitters):
+		"""same as find_collisions but uses the index Collisions built over every group's emitters"""
+		det_slots = shared.lookup_slots(detectors)
+		em_slots = shared.lookup_emitter_slots(self)
+
+		det_idx, em_slot = shared.query(det_slots)
+		self._candidate_pairs = len(det_idx)
+
+		# the shared index holds every group's emitters, so throw out the ones that aren't in this group
+		em_local = np.full(len(shared.objects), -1, dtype=np.int64)
+		em_local[em_slots] = np.arange(len(emitters))
+		em_idx = em_local[em_slot]
+		keep = em_idx >= 0
+		if self._interests is not None:
+			keep &= self.handled_pair_mask(shared.types[det_slots[det_idx]], shared.types[em_slot])
+
+		det = select_geometry(shared.geometry, det_slots)
+		em = select_geometry(shared.geometry, em_slots)
+		return self.circle_collisions(det, em, det_idx[keep], em_idx[keep])
+
+	def handled_pair_mask(self, det_types, em_types):
+		"""True for each (detector type, emitter type) pair that has a handler"""
+		keep = np.zeros(len(det_types), dtype=bool)
+		for detector_type, emitter_types in self._interests.items():
+			keep |= (det_types == detector_type) & np.isin(em_types, emitter_types)
+		return keep
+
+	def find_collisions_by_type(self, detectors, emitters, det, em):
+		"""only tests each type of detector against the emitter types it has a handler for"""
+		det_types = np.array([co.type for co in detectors])
+		em_types = np.array([co.type for co in emitters])
+
+		det_parts = []
+		em_parts = []
+		dist_parts = []
+		for detector_type, emitter_types in self._interests.items():
+			det_sel = np.flatnonzero(det_types == detector_type)
+			if len(det_sel) == 0:
+				continue
+
+			em_sel = np.flatnonzero(np.isin(em_types, emitter_types))
+			if len(em_sel) == 0:
+				continue
+
+			det_idx, em_idx, dist_sqrd = self.find_collisions(select_geometry(det, det_sel), select_geometry(em, em_sel), detector_type)
+			det_parts.append(det_sel[det_idx])  # map back to indices into the full lists
+			em_parts.append(em_sel[em_idx])
+			dist_parts.append(dist_sqrd)
+
+		if not det_parts:
+			return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+
+		det_idx = np.concatenate(det_parts)
+		em_idx = np.concatenate(em_parts)
+		dist_sqrd = np.concatenate(dist_parts)
+		order = np.lexsort((em_idx, det_idx))
+		return det_idx[order], em_idx[order], dist_sqrd[order]
+
+	# ----- Narrow phase ----------------
+
+	def circle_collisions(self, det, em, det_idx, em_idx):
+		"""tests only the candidate pairs.  returns the (detector, emitter) indices that overlap and their
+			squared distance"""
+		det_x, det_y, det_r, det_owner = det
+		em_x, em_y, em_r, em_owner = em
+
+		dx = det_x[det_idx] - em_x[em_idx]
+		dy = det_y[det_idx] - em_y[em_idx]
+		dist_sqrd = (dx * dx) + (dy * dy)
+
+		hit = dist_sqrd < (det_r[det_idx] + em_r[em_idx])**2
+		hit &= det_owner[det_idx] != em_owner[em_idx]
+		det_idx = det_idx[hit]
+		em_idx = em_idx[hit]
+		dist_sqrd = dist_sqrd[hit]
+
+		order = np.lexsort((em_idx, det_idx))  # report in the same order as brute force
+		return det_idx[order], em_idx[order], dist_sqrd[order]
+
+
+def gather_geometry(collision_objects):
+	"""returns contiguous arrays of x, y, radius and owner id for a list of collision objects"""
+	x = np.array([co.get_abs_x() for co in collision_objects], dtype=float)
+	y = np.array([co.get_abs_y() for co in collision_objects], dtype=float)
+	r = np.array([co.get_size() for co in collision_objects], dtype=float)
+	owner = np.array([id(co.ci.owner) for co in collision_objects], dtype=np.int64)
+	return x, y, r, owner
+
+
+def is_broad_phase(broad_phase):
+	if isinstance(broad_phase, type) and issubclass(broad_phase, BroadPhase):
+		return True
+	logging.error("Unsupported broad phase: " + str(broad_phase))
+	return False
+
+
+def select_geometry(geometry, selection):
+	"""returns the geometry arrays for just the selected indices"""
+	return tuple(a[selection] for a in geometry)
+
+
+def all_pairs(num_detectors, num_emitters):
+	"""returns index arrays that pair every detector with every emitter"""
+	det_idx = np.repeat(np.arange(num_detectors), num_emitters)
+	em_idx = np.tile(np.arange(num_emitters), num_detectors)
+	return det_idx, em_idx
+
+
+def expand_ranges(start, counts):
+	"""turns ranges [start, start + count) into one flat array of indices"""
+	total = counts.sum()
+	offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+	return np.repeat(start, counts) + offsets
 
 
 class CollisionMatrix:
 	"""This class encapsulates what happens between two objects once the collision is detected"""
 
-	def __init__(self, collision_dictionary):
+	def __init__(self, collision_dictionary, enter_dictionary=None, exit_dictionary=None, batch_dictionary=None):
+		""" collision_dictionary: (detector type, emitter type) -> method called every step the two overlap
+			enter_dictionary, exit_dictionary: optional, same keys.  Called once when the two start or stop
+			overlapping.  Use track_contacts to turn them on
+			batch_dictionary: optional, same keys.  Methods that handle all of the hits of a pair type at once.
+			Only used if invoke_batch_handler is the group's handler """
 		self.collision_dictionary = collision_dictionary
-
-	def invoke_handler(self, detector, emitter):
-		self.print_collision(detector, emitter)
-		collision_data = self.extract_collision_data(detector, emitter)
+		self.enter_dictionary = enter_dictionary or {}
+		self.exit_dictionary = exit_dictionary or {}
+		self.batch_dictionary = batch_dictionary or {}
+
+	def track_contacts(self, collisions, collision_type):
+		"""asks the collision group to report when contacts start and end"""
+		collisions.set_contact_handlers(collision_type, self.invoke_enter_handler, self.invoke_exit_handler)
+
+	def invoke_enter_handler(self, detector, emitter):
+		handler = self.enter_dictionary.get((detector.type, emitter.type))
+		if handler is not None:  # most pairs only care about the regular handler
+			handler(detector, emitter)
+
+	def invoke_exit_handler(self, detector, emitter):
+		handler = self.exit_dictionary.get((detector.type, emitter.type))
+		if handler is not None:
+			handler(detector, emitter)
+
+	def get_handled_pairs(self):
+		"""the (detector type, emitter type) pairs that have a handler.  Used by the groups to skip all the others"""
+		return self.collision_dictionary.keys()
+
+	def invoke_handler(self, detector, emitter, dist_sqrd=None):
+		if logger.isEnabledFor(logging.DEBUG):  # don't build the strings unless they will be logged
+			self.print_collision(detector, emitter)
 		try:
 			self.collision_dictionary[(detector.type, emitter.type)](detector, emitter)  # use types to lookup function to call and then call it
 		except KeyError:
 			logging.warning('No handler for: ' + detector.name + ' T:' + str(detector.type) + ", " + emitter.name + ' T:' + str(emitter.type))
 
-	def extract_collision_data(self, detector, emitter):
+	def invoke_batch_handler(self, detectors, emitters, det_idx, em_idx, dist_sqrd):
+		"""called once per step with all of the hits (see CollisionGroup.set_handler).  The hits are split by
+			(detector type, emitter type).  Each pair type goes to its batch handler as index arrays,
+			handler(detectors, emitters, det_idx, em_idx), or one hit at a time to the regular handler if it
+			doesn't have one"""
+		det_types = np.array([co.type for co in detectors])[det_idx]
+		em_types = np.array([co.type for co in emitters])[em_idx]
+		pair_types, pair_of_hit = np.unique(np.column_stack((det_types, em_types)), axis=0, return_inverse=True)
+		pair_of_hit = pair_of_hit.ravel()
+
+		for n, (detector_type, emitter_type) in enumerate(pair_types.tolist()):
+			hits = np.flatnonzero(pair_of_hit == n)
+			batch_handler = self.batch_dictionary.get((detector_type, emitter_type))
+			if batch_handler is not None:
+				batch_handler(detectors, emitters, det_idx[hits], em_idx[hits])
+				continue
+
+			handler = self.collision_dictionary.get((detector_type, emitter_type))
+			if handler is None:
+				logging.warning('No handler for types: ' + str(detector_type) + ", " + str(emitter_type))
+				continue
+			for i, j in zip(det_idx[hits].tolist(), em_idx[hits].tolist()):
+				handler(detectors[i], emitters[j])
+
+	def extract_collision_data(self, detector, emitter, dist_sqrd=None):
 		"""
 			can be overwritten so that different collisions can return different data.
 			expected return is a dictionary of name-value pairs
 			by default it returns a dictionary containing the distance between the two objects squared
 			leaving as an instance method in case there is a subclass instance variable that needs to be accessed
+			dist_sqrd: already worked out by the collision group, if known
 		"""
+		if dist_sqrd is not None:
+			return {'dist_sqrd':dist_sqrd}
+
 		dx = detector.get_abs_x() - emitter.get_abs_x()
 		dy = detector.get_abs_y() - emitter.get_abs_y()
 		dist_sqrd = (dx * dx) + (dy * dy)
@@ -173,16 +967,28 @@ class Collisions:
 	PHYSICAL = 'physical'
 	VISUAL = 'visual'
 	valid_types = [PHYSICAL, VISUAL] #"sound, smell, communication, click
-	collision_groups = {}
 
 	def default_handler(self, *kwargs ):  # this should only be called if no handler is set for a collision group.
 		logging.error("Error, no handler set for the group.  Need to instantiate a CollisionMatrix and assign handler")
 
-	def __init__(self):
+	def __init__(self, bounds=None, wrap=False, broad_phase=UniformGridBroadPhase, shared_geometry=True):
+		""" bounds: (width, height) of the world
+			wrap: True if objects leaving one edge of the world enter on the other
+			broad_phase: the BroadPhase class used to find candidate pairs
+			shared_geometry: if True, positions are gathered and indexed once per step for all groups.
+				Otherwise each group gathers and indexes its own """
+		self._bounds = bounds
+		self._wrap = wrap
+		self._shared_geometry = shared_geometry
+		self._broad_phase = broad_phase(bounds, wrap)  # the index shared by all of the groups
+		self._ray_broad_phase = broad_phase(bounds, wrap)  # rays reach a lot further, so they get their own index
+		self._static_layer = StaticLayer(broad_phase(bounds, wrap))  # kept between steps
+
 		#for each type, create a group
 		#add the group to the dictionary
+		self.collision_groups = {}
 		for collision_type in Collisions.valid_types:
-			self.collision_groups[collision_type] = CollisionGroup(self.default_handler)  #add a collision group
+			self.collision_groups[collision_type] = CollisionGroup(self.default_handler, bounds, wrap, broad_phase)  #add a collision group
 
 	def lookup_group(self, collision_type):
 		"""use to encapsulate error handling for groups that are found"""
@@ -192,33 +998,183 @@ class Collisions:
 			logging.warning("invalid collision type: ", collision_type)
 			exit()
 
-	def set_collision_handler(self, collision_type, handler):
-		"""this is used so a particular collision type can set the specific handler to set the collision data."""
+	def set_collision_handler(self, collision_type, handler, handled_pairs=None, nearest=None, batch=False):
+		"""this is used so a particular collision type can set the specific handler to set the collision data.
+			handled_pairs: optional (detector type, emitter type) pairs the handler cares about.
+			nearest: optional number of closest emitters to hand to the handler per detector.
+			batch: True to hand every hit to the handler at once.  See CollisionGroup.set_handler"""
 		group = self.lookup_group(collision_type)
-		group.set_handler(handler)
+		group.set_handler(handler, handled_pairs, nearest, batch)
 
-	def register_emitter(self, collision_object, collision_type):
+	def register_emitter(self, collision_object, collision_type, static=False):
 		#look up in the dictionary to get correct group
 		#invoke add emitter on that group
+		#returns the handle needed to deregister
 		group = self.lookup_group(collision_type)
-		group.add_emitter(collision_object)
+		return group.add_emitter(collision_object, static)
 
 	def register_detector(self, collision_object, collision_type):
 		group = self.lookup_group(collision_type)
-		group.add_detector(collision_object)
+		return group.add_detector(collision_object)
+
+	def register_emitters(self, collision_objects, collision_type, static=False):
+		"""register_emitter for a batch of objects.  returns their handles"""
+		group = self.lookup_group(collision_type)
+		return group.add_emitters(collision_objects, static)
+
+	def register_detectors(self, collision_objects, collision_type):
+		group = self.lookup_group(collision_type)
+		return group.add_detectors(collision_objects)
 
-	def deregister_emitter(self, collision_object, collision_type):
+	def deregister_emitter(self, handle, collision_type):
 		group = self.lookup_group(collision_type)
-		group.del_emitter(collision_object)
+		group.del_emitter(handle)
 
-	def deregister_detector(self, collision_object, collision_type):
+	def deregister_detector(self, handle, collision_type):
 		group = self.lookup_group(collision_type)
-		group.del_detector(collision_object)
+		group.del_detector(handle)
 
-	def detect_collisions(self):
+	def static_emitter_changed(self, handle, collision_type, rebuild=True):
+		group = self.lookup_group(collision_type)
+		collision_object = group.static_emitter_changed(handle, rebuild)
+		if collision_object is not None and not rebuild:
+			self._static_layer.patch(collision_object)
+
+	def get_static_rebuilds(self):
+		"""number of times the static emitters have been gathered and indexed for the shared geometry"""
+		return self._static_layer.rebuilds
+
+	def set_contact_handlers(self, collision_type, on_enter, on_exit):
+		"""turns on contact tracking for a collision type.  See CollisionGroup.set_contact_handlers"""
+		group = self.lookup_group(collision_type)
+		group.set_contact_handlers(on_enter, on_exit)
+
+	def set_broad_phase(self, broad_phase):
+		if not is_broad_phase(broad_phase):
+			return
+		self._broad_phase = broad_phase(self._bounds, self._wrap)
+		self._ray_broad_phase = broad_phase(self._bounds, self._wrap)
+		self._static_layer = StaticLayer(broad_phase(self._bounds, self._wrap))
+		for collision_group in self.collision_groups.values():
+			collision_group.set_broad_phase(broad_phase)
+
+	def set_shared_geometry(self, shared_geometry):
+		self._shared_geometry = shared_geometry
+
+	def get_candidate_pairs(self):
+		"""collision type -> number of candidate pairs its broad phase produced in the last detection.
+			Use it to compare how well the broad phases prune for a given density and world size"""
+		return {collision_type: group.get_candidate_pairs() for collision_type, group in self.collision_groups.items()}
+
+	def detect_collisions(self, skip=()):
+		"""skip: collision types not to check this step, e.g., when vision runs less often than physics.  Unlike
+			disabling a group, it doesn't change what is gathered so nothing has to be rebuilt the next step"""
 		#loop through all of the groups and check for collisions
-		for collision_type, collision_group in self.collision_groups.items():
-			collision_group.detect_collisions()
+		if not self._shared_geometry:
+			for collision_type, collision_group in self.collision_groups.items():
+				if collision_type not in skip:
+					collision_group.detect_collisions()
+			return
+
+		# gather every object once, index every emitter once and let each group query that
+		groups = [(collision_type, group) for collision_type, group in self.collision_groups.items() if group.is_enabled()]
+		self._broad_phase.start_detection(tuple(group._emitters.version for collision_type, group in groups))
+		shared = SharedGeometry([group for collision_type, group in groups], self._broad_phase, self._static_layer)
+		for collision_type, collision_group in groups:
+			if collision_type not in skip:
+				collision_group.detect_collisions(shared)
+
+	def wrapped_copies(self, x, y, reach):
+		"""returns x, y and the index of the point each came from for the points plus a copy of every point within
+			reach of an edge moved to just past the opposite edge (and corner)"""
+		width, height = self._bounds
+		all_points = np.ones(len(x), dtype=bool)
+		near_x = {0: all_points, width: x < reach, -width: x > width - reach}
+		near_y = {0: all_points, height: y < reach, -height: y > height - reach}
+		copies_x, copies_y, copies = [x], [y], [np.arange(len(x))]
+		for shift_x, in_x in near_x.items():
+			for shift_y, in_y in near_y.items():
+				if shift_x or shift_y:
+					near = np.flatnonzero(in_x & in_y)
+					copies_x.append(x[near] + shift_x)
+					copies_y.append(y[near] + shift_y)
+					copies.append(near)
+		return np.concatenate(copies_x), np.concatenate(copies_y), np.concatenate(copies)
+
+	def cast_rays(self, collision_type, origin_x, origin_y, directions, max_range, owners=None):
+		"""line of sight for many casters at once against the emitters of a collision type.
+			origin_x, origin_y: (casters,) arrays of where the rays start
+			directions: (casters, rays, 2) array of unit vectors
+			max_range: how far a ray can see
+			owners: optional (casters,) array of owner ids, id(owner).  A ray can't hit its own owner
+			returns (emitters, em_idx, dist).  em_idx[c, k] is the index into emitters of the first thing
+			ray k of caster c hits, or -1 for nothing.  dist is how far along the ray it was hit, inf for nothing.
+			Only the first hit counts, so things behind it are hidden"""
+		group = self.lookup_group(collision_type)
+		emitters = group.emitter_list()
+		num_casters, num_rays = directions.shape[:2]
+		em_idx = np.full((num_casters, num_rays), -1)
+		dist = np.full((num_casters, num_rays), np.inf)
+		if not emitters or not num_casters:
+			return emitters, em_idx, dist
+
+		# any emitter a ray can reach overlaps a circle of the ray's length around the caster
+		em = group.gather_emitters()
+		caster_owners = owners if owners is not None else np.zeros(num_casters, dtype=np.int64)
+		query_x, query_y, query_caster = origin_x, origin_y, np.arange(num_casters)
+		if self._wrap:  # not every broad phase looks across the edges, so casters near one also look from the other side
+			query_x, query_y, query_caster = self.wrapped_copies(origin_x, origin_y, max_range + em[2].max())
+		casters = (query_x, query_y, np.full(len(query_x), float(max_range)), caster_owners[query_caster])
+		self._ray_broad_phase.start_detection(group.emitters_version())
+		self._ray_broad_phase.build(em, float(max_range), 'rays')
+		caster_idx, cand_idx = self._ray_broad_phase.query(casters)
+		caster_idx = query_caster[caster_idx]
+		if owners is not None:
+			keep = em[3][cand_idx] != owners[caster_idx]
+			caster_idx, cand_idx = caster_idx[keep], cand_idx[keep]
+
+		# test every ray of the caster against each candidate
+		caster_idx = np.repeat(caster_idx, num_rays)
+		cand_idx = np.repeat(cand_idx, num_rays)
+		ray_idx = np.tile(np.arange(num_rays), len(caster_idx) // num_rays)
+		ox, oy = origin_x[caster_idx], origin_y[caster_idx]
+		cx, cy = em[0][cand_idx], em[1][cand_idx]
+		if self._wrap:  # the broad phase hands out candidates across the edges, so aim at the copy on this side
+			cx, cy = nearest_image(ox, oy, cx, cy, self._bounds)
+		t = ray_circle_hits(ox, oy, directions[caster_idx, ray_idx], cx, cy, em[2][cand_idx])
+		hit = t <= max_range
+		caster_idx, ray_idx, cand_idx, t = caster_idx[hit], ray_idx[hit], cand_idx[hit], t[hit]
+
+		# keep the closest hit of each ray
+		order = np.lexsort((t, ray_idx, caster_idx))
+		ray_key = caster_idx[order] * num_rays + ray_idx[order]
+		first = np.ones(len(order), dtype=bool)
+		first[1:] = ray_key[1:] != ray_key[:-1]
+		closest = order[first]
+		em_idx[caster_idx[closest], ray_idx[closest]] = cand_idx[closest]
+		dist[caster_idx[closest], ray_idx[closest]] = t[closest]
+		return emitters, em_idx, dist
+
+
+def nearest_image(x, y, to_x, to_y, bounds):
+	"""returns to_x, to_y moved by whole widths and heights of a wrapped world to the copy closest to x, y"""
+	width, height = bounds
+	return to_x - width * np.round((to_x - x) / width), to_y - height * np.round((to_y - y) / height)
+
+
+def ray_circle_hits(ox, oy, direction, cx, cy, r):
+	"""distance along each ray (origin ox, oy, unit direction) to where it enters the circle (cx, cy, r).
+		0 if the ray starts inside the circle, inf if it misses"""
+	mx = ox - cx
+	my = oy - cy
+	b = mx * direction[:, 0] + my * direction[:, 1]
+	c = mx * mx + my * my - r * r
+	disc = b * b - c
+	t = np.full(len(ox), np.inf)
+	ahead = (disc >= 0) & (b <= 0)  # the line crosses the circle in front of the origin
+	t[ahead] = -b[ahead] - np.sqrt(disc[ahead])
+	t[c <= 0] = 0
+	return t
 
 
 # --- Testing Code after this point --------------------------------------------------------------------------------
@@ -271,13 +1227,14 @@ class CollisionTestObject: #simlar to BugWorldObject
 
 class CollisionTestBody(CollisionTestObject):
 
-	def __init__(self, collisions, name, test_type, x, y, size):
+	def __init__(self, collisions, name, test_type, x, y, size, static=False):
 		super().__init__(collisions, name, x, y, size)
 		self.type = test_type
 
-		self.ci.register_as_emitter(self, 'visual')
-		self.ci.register_as_emitter(self, 'physical')
-		self.ci.register_as_detector(self, 'physical')
+		self.ci.register_as_emitter(self, 'visual', static)
+		self.ci.register_as_emitter(self, 'physical', static)
+		if not static:
+			self.ci.register_as_detector(self, 'physical')
 
 
 class CollisionTestEye(CollisionTestObject):
@@ -293,7 +1250,7 @@ class PhysicalCollisionMatrix(CollisionMatrix):
 	def __init__(self, collisions):
 		super().__init__(self.get_collision_dictionary())
 		self.collisions = collisions
-		self.collisions.set_collision_handler('physical', self.invoke_handler)
+		self.collisions.set_collision_handler('physical', self.invoke_handler, self.get_handled_pairs())
 
 	def herb_carn(self, herb, carn):
 		self.print_test_message(herb,carn)
@@ -324,7 +1281,7 @@ class VisualCollisionMatrix(CollisionMatrix):
 	def __init__(self, collisions):
 		super().__init__(self.get_collision_dictionary())
 		self.collisions = collisions
-		self.collisions.set_collision_handler('visual', self.invoke_handler)
+		self.collisions.set_collision_handler('visual', self.invoke_handler, self.get_handled_pairs())
 
 	def bug_eye(self, bug, eye):
 		self.print_test_message(bug,eye)
@@ -390,7 +1347,6 @@ class CollisionTestWorld():  # Similar to BugWorld
 
 		self.collisions.detect_collisions()
 		logging.debug("After Collision Check")
-		logging.debug()
 
 		self.del_body()
 		logging.debug("After delete body")
@@ -411,6 +1367,263 @@ class CollisionTestWorld():  # Similar to BugWorld
 		#handle two subclasses colliding....eg carn,herb
 
 
+	def test_broad_phase(self, num_bodies=200, bounds=(100, 80), wrap=True, handled_pairs=None):
+		"""every broad phase must report exactly the same collisions as brute force, including at wrapped edges.
+			If handled_pairs is given, only those type pairs may reach the handler"""
+		collisions = Collisions(bounds, wrap)
+		hits = []
+		collisions.set_collision_handler('physical', lambda co1, co2, dist_sqrd: hits.append((co1.name, co2.name, round(dist_sqrd, 6))), handled_pairs)
+		collisions.set_collision_handler('visual', lambda co1, co2, dist_sqrd: hits.append((co1.name, co2.name, round(dist_sqrd, 6))), handled_pairs)
+
+		width, height = bounds
+		for i in range(num_bodies):
+			# let some objects hang over the edges of the world like an eye hitbox on a bug at the boundary
+			x = random.uniform(-5, width + 5)
+			y = random.uniform(-5, height + 5)
+			test_type = random.choice([CTOType.HERB, CTOType.CARN, CTOType.OBST])
+			CollisionTestBody(collisions, "body" + str(i), test_type, x, y, random.uniform(0.5, 4), test_type == CTOType.OBST)
+			CollisionTestEye(collisions, None, "Eye" + str(i), x, y, 2)
+
+		# work out the expected collisions one pair at a time
+		expected = []
+		for group in collisions.collision_groups.values():
+			for co1 in group._detectors:
+				for co2 in group.emitter_list():
+					dx = co1.get_abs_x() - co2.get_abs_x()
+					dy = co1.get_abs_y() - co2.get_abs_y()
+					if handled_pairs is not None and (co1.type, co2.type) not in handled_pairs:
+						continue
+					if not co1.ci.is_this_me(co2) and dx*dx + dy*dy < (co1.get_size() + co2.get_size())**2:
+						expected.append((co1.name, co2.name, round(dx*dx + dy*dy, 6)))
+		expected.sort()
+		assert len(expected) > 0, "test world too sparse to check anything"
+
+		for shared_geometry in (True, False):
+			collisions.set_shared_geometry(shared_geometry)
+			for broad_phase in (BruteForceBroadPhase, UniformGridBroadPhase, SweepAndPruneBroadPhase, KDTreeBroadPhase):
+				collisions.set_broad_phase(broad_phase)
+				hits.clear()
+				collisions.detect_collisions()
+				assert sorted(hits) == expected, broad_phase.__name__ + " missed or added collisions"
+				logging.info(broad_phase.__name__ + " candidate pairs: " + str(collisions.get_candidate_pairs()))
+
+	def test_registration(self, num_objects=50):
+		"""handles must stay valid while other objects are removed around them"""
+		registrations = RegistrationList()
+		handles = {name: registrations.add(name) for name in range(num_objects)}
+
+		for name in range(0, num_objects, 3):  # remove from the front, middle and end
+			registrations.remove(handles.pop(name))
+		registrations.remove(handles.pop(num_objects - 1))
+
+		assert sorted(registrations) == sorted(handles), "wrong objects left after removal"
+
+		# adding a batch works the same as adding them one at a time
+		handles.update(zip(range(num_objects, 2 * num_objects), registrations.add_all(range(num_objects, 2 * num_objects))))
+		registrations.remove(handles.pop(num_objects))
+		assert sorted(registrations) == sorted(handles), "wrong objects after adding a batch"
+		for name, handle in handles.items():
+			registrations.remove(handle)
+			assert name not in registrations, "removed the wrong object"
+		assert len(registrations) == 0
+
+	def test_nearest(self, num_bodies=200, bounds=(100, 80), nearest=2):
+		"""each eye should be handed only its closest emitters, closest first"""
+		collisions = Collisions(bounds, wrap=True)
+		seen = {}
+		collisions.set_collision_handler('visual', lambda eye, hits: seen.setdefault(eye.name, []).extend(hits), nearest=nearest)
+		collisions.set_collision_handler('physical', lambda co1, co2, dist_sqrd: None)
+
+		width, height = bounds
+		for i in range(num_bodies):
+			CollisionTestBody(collisions, "body" + str(i), CTOType.HERB, random.uniform(0, width), random.uniform(0, height), 2)
+			CollisionTestEye(collisions, None, "Eye" + str(i), random.uniform(0, width), random.uniform(0, height), 8)
+		collisions.detect_collisions()
+
+		group = collisions.lookup_group('visual')
+		for eye in group._detectors:
+			overlaps = []
+			for body in group._emitters:
+				dx = eye.get_abs_x() - body.get_abs_x()
+				dy = eye.get_abs_y() - body.get_abs_y()
+				if dx*dx + dy*dy < (eye.get_size() + body.get_size())**2:
+					overlaps.append((dx*dx + dy*dy, body.name))
+			expected = [name for dist_sqrd, name in sorted(overlaps)[:nearest]]
+			assert [body.name for body, dist_sqrd in seen.get(eye.name, [])] == expected, "wrong nearest for " + eye.name
+
+		seen.clear()
+		collisions.detect_collisions(skip=('visual',))
+		assert not seen, "skipped group shouldn't be checked"
+
+	def test_contacts(self, num_bodies=100, bounds=(100, 80), num_steps=20):
+		"""move things around for a few steps.  sweep and prune must keep matching brute force as it reuses its
+			order, and every contact must enter once and exit once"""
+		collisions = Collisions(bounds, True, SweepAndPruneBroadPhase)
+		reference = Collisions(bounds, True, BruteForceBroadPhase)
+		hits = {collisions: [], reference: []}
+		for c in hits:
+			c.set_collision_handler('physical', lambda co1, co2, dist_sqrd, c=c: hits[c].append((co1.name, co2.name)))
+
+		events = []
+		collisions.set_contact_handlers('physical', lambda co1, co2: events.append(('enter', co1.name, co2.name)),
+										lambda co1, co2: events.append(('exit', co1.name, co2.name)))
+
+		width, height = bounds
+		bodies = []
+		for i in range(num_bodies):
+			x, y = random.uniform(0, width), random.uniform(0, height)
+			bodies.append(CollisionTestBody(collisions, "body" + str(i), CTOType.HERB, x, y, 2))
+			bodies.append(CollisionTestBody(reference, "body" + str(i), CTOType.HERB, x, y, 2))
+
+		touching = set()
+		for step in range(num_steps):
+			for body in bodies[::2]:  # move each pair of bodies the same way
+				body.x += random.uniform(-1, 1)
+				body.y += random.uniform(-1, 1)
+			for body, twin in zip(bodies[::2], bodies[1::2]):
+				twin.x, twin.y = body.x, body.y
+
+			for c in hits:
+				hits[c].clear()
+				c.detect_collisions()
+			assert sorted(hits[collisions]) == sorted(hits[reference]), "sweep and prune lost track at step " + str(step)
+
+			now_touching = set(hits[collisions])
+			expected = [('enter',) + pair for pair in now_touching - touching] + [('exit',) + pair for pair in touching - now_touching]
+			assert sorted(events) == sorted(expected), "wrong contact events at step " + str(step)
+			events.clear()
+			touching = now_touching
+
+	def test_batch_dispatch(self, num_bodies=200, bounds=(100, 80)):
+		"""batch dispatch must hand every hit to exactly one handler, batched or not"""
+		pairs = []
+		batched = []
+
+		def per_pair(co1, co2):
+			pairs.append((co1.name, co2.name))
+
+		def batch(detectors, emitters, det_idx, em_idx):
+			batched.extend((detectors[i].name, emitters[j].name) for i, j in zip(det_idx, em_idx))
+
+		per_pair_dictionary = {(CTOType.HERB, CTOType.CARN): per_pair, (CTOType.HERB, CTOType.HERB): per_pair}
+		batch_dictionary = {(CTOType.HERB, CTOType.HERB): batch}
+		reference = CollisionMatrix(per_pair_dictionary)
+		matrix = CollisionMatrix(per_pair_dictionary, batch_dictionary=batch_dictionary)
+
+		collisions = Collisions(bounds, True)
+		width, height = bounds
+		for i in range(num_bodies):
+			CollisionTestBody(collisions, "body" + str(i), random.choice([CTOType.HERB, CTOType.CARN]),
+							  random.uniform(0, width), random.uniform(0, height), random.uniform(0.5, 4))
+
+		collisions.set_collision_handler('physical', reference.invoke_handler, reference.get_handled_pairs())
+		collisions.detect_collisions()
+		expected = sorted(pairs)
+		pairs.clear()
+
+		collisions.set_collision_handler('physical', matrix.invoke_batch_handler, matrix.get_handled_pairs(), batch=True)
+		collisions.detect_collisions()
+		assert batched, "test world too sparse to check anything"
+		assert sorted(pairs + batched) == expected, "batch dispatch lost or added hits"
+
+	def test_rays(self, num_bodies=150, num_rays=7, bounds=(300, 200)):
+		"""every ray must stop at the first body it enters, checked one ray and one body at a time"""
+		collisions = Collisions(bounds, True)
+		width, height = bounds
+		bodies = [CollisionTestBody(collisions, "body" + str(i), CTOType.HERB, random.uniform(0, width),
+									random.uniform(0, height), random.uniform(1, 8)) for i in range(num_bodies)]
+		casters = bodies[:20]
+		x = np.array([b.x for b in casters], dtype=float)
+		y = np.array([b.y for b in casters], dtype=float)
+		angles = np.random.uniform(0, 2 * np.pi, (len(casters), num_rays))
+		directions = np.stack((np.cos(angles), np.sin(angles)), axis=2)
+		owners = np.array([id(b) for b in casters], dtype=np.int64)
+		max_range = 40
+
+		for broad_phase in (BruteForceBroadPhase, UniformGridBroadPhase, SweepAndPruneBroadPhase, KDTreeBroadPhase):
+			collisions.set_broad_phase(broad_phase)
+			emitters, em_idx, dist = collisions.cast_rays('physical', x, y, directions, max_range, owners)
+			for c, caster in enumerate(casters):
+				for k in range(num_rays):
+					best, best_t = -1, np.inf
+					for e, body in enumerate(emitters):
+						if body is caster:
+							continue
+						# the world wraps, so try every copy of the body around the world
+						for shift_x in (-width, 0, width):
+							for shift_y in (-height, 0, height):
+								t = ray_circle_hits(x[c:c + 1], y[c:c + 1], directions[c, k:k + 1],
+									np.array([body.x + shift_x]), np.array([body.y + shift_y]), np.array([body.size]))[0]
+								if t <= max_range and t < best_t:
+									best, best_t = e, t
+					assert em_idx[c, k] == best or np.isclose(dist[c, k], best_t), \
+						broad_phase.__name__ + " ray hit the wrong body"
+					assert np.isclose(dist[c, k], best_t), broad_phase.__name__ + " ray distance"
+
+		# straight along x: the ray enters a circle of radius 2 at x=8 and the one behind it is hidden
+		collisions = Collisions(bounds, True)
+		CollisionTestBody(collisions, "near", CTOType.HERB, 10, 50, 2)
+		CollisionTestBody(collisions, "far", CTOType.HERB, 20, 50, 2)
+		emitters, em_idx, dist = collisions.cast_rays('physical', np.array([0.0]), np.array([50.0]),
+													  np.array([[[1.0, 0.0], [-1.0, 0.0]]]), 30)
+		assert emitters[em_idx[0, 0]].name == "near" and np.isclose(dist[0, 0], 8), "occlusion failed"
+		assert em_idx[0, 1] == -1 and dist[0, 1] == np.inf, "ray behind should see nothing"
+
+		# across the edge: looking left from x=2 sees the body at x=295, whose edge is 5 away through the seam
+		for broad_phase in (BruteForceBroadPhase, UniformGridBroadPhase, SweepAndPruneBroadPhase, KDTreeBroadPhase):
+			collisions = Collisions(bounds, True, broad_phase)
+			CollisionTestBody(collisions, "across", CTOType.HERB, 295, 50, 2)
+			emitters, em_idx, dist = collisions.cast_rays('physical', np.array([2.0]), np.array([50.0]),
+														  np.array([[[-1.0, 0.0], [1.0, 0.0]]]), 30)
+			assert em_idx[0, 0] == 0 and np.isclose(dist[0, 0], 5), broad_phase.__name__ + " ray didn't cross the edge"
+			assert em_idx[0, 1] == -1, broad_phase.__name__ + " body is too far the other way"
+
+	def test_static_layer(self, num_bodies=100, bounds=(100, 80), num_steps=10):
+		"""moving things around static ones must keep matching brute force, and the static index must only be
+			rebuilt when a static emitter is added, removed or changed"""
+		collisions = Collisions(bounds, True, UniformGridBroadPhase)
+		hits = []
+		collisions.set_collision_handler('physical', lambda co1, co2, dist_sqrd: hits.append((co1.name, co2.name)))
+
+		width, height = bounds
+		moving = [CollisionTestBody(collisions, "body" + str(i), CTOType.HERB, random.uniform(0, width),
+									random.uniform(0, height), 2) for i in range(num_bodies)]
+		static = [CollisionTestBody(collisions, "obst" + str(i), CTOType.OBST, random.uniform(0, width),
+									random.uniform(0, height), random.uniform(1, 4), static=True) for i in range(num_bodies)]
+
+		def expected():
+			group = collisions.lookup_group('physical')
+			pairs = []
+			for co1 in group._detectors:
+				for co2 in group.emitter_list():
+					dx = co1.get_abs_x() - co2.get_abs_x()
+					dy = co1.get_abs_y() - co2.get_abs_y()
+					if co1 is not co2 and dx*dx + dy*dy < (co1.get_size() + co2.get_size())**2:
+						pairs.append((co1.name, co2.name))
+			return sorted(pairs)
+
+		for step in range(num_steps):
+			for body in moving:
+				body.x = (body.x + random.uniform(-2, 2)) % width
+				body.y = (body.y + random.uniform(-2, 2)) % height
+			if step == num_steps // 2 - 1:  # shrinking only patches the index
+				static[1].size = 0.5
+				static[1].ci.static_changed(rebuild=False)
+			if step == num_steps // 2:  # grow one, remove one, add one
+				static[0].size = 12
+				static[0].ci.static_changed()
+				static.pop().kill()
+				static.append(CollisionTestBody(collisions, "late", CTOType.OBST, width / 2, height / 2, 5, static=True))
+				rebuilds = collisions.get_static_rebuilds()
+			hits.clear()
+			collisions.detect_collisions()
+			assert sorted(hits) == expected(), "static layer missed or added collisions at step " + str(step)
+			if step == 0:
+				assert collisions.get_static_rebuilds() == 1
+			elif step == num_steps // 2:
+				assert collisions.get_static_rebuilds() == rebuilds + 1, "changes should rebuild the static index once"
+		assert collisions.get_static_rebuilds() == 2, "static index rebuilt when nothing static changed"
+
 	#test recursive isThisMe
 
 	#test adding handler methods
@@ -428,3 +1641,12 @@ class CollisionTestWorld():  # Similar to BugWorld
 if __name__ == "__main__":
 	g = CollisionTestWorld()
 	g.test_all()
+	g.test_registration()
+	g.test_broad_phase()
+	g.test_broad_phase(wrap=False)
+	g.test_nearest()
+	g.test_contacts()
+	g.test_batch_dispatch()
+	g.test_rays()
+	g.test_static_layer()
+	g.test_broad_phase(handled_pairs=set(g.pcm.get_handled_pairs()) | set(g.vcm.get_handled_pairs()))
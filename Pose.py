@@ -0,0 +1,147 @@
+import math
+import timeit
+import numpy as np
+
+'''
+Position and heading of an object in the x,y plane.
+
+Same meaning as the 4x4 affine transforms the world used to use: the object's local frame faces along its x axis
+and positive rotation goes from the x axis into the y axis.  A pose can also flip the y axis (mirror = -1), which
+is what maps Bug World coords to the canvas.
+
+	p1.compose(p2) is the same as matmul(T1, T2): p2 is given in p1's frame, the result is in p1's container's frame
+'''
+
+
+class Pose:
+	"""2D rigid transform stored as x, y, theta and a mirror flag (1, or -1 to flip the y axis)"""
+
+	__slots__ = ('x', 'y', 'theta', 'mirror')
+
+	def __init__(self, x=0.0, y=0.0, theta=0.0, mirror=1):
+		self.x = x
+		self.y = y
+		self.theta = theta
+		self.mirror = mirror
+
+	def __repr__(self):
+		return "Pose(x={:.2f}, y={:.2f}, theta={:.3f}, mirror={})".format(self.x, self.y, self.theta, self.mirror)
+
+	def compose(self, other):
+		"""returns self * other"""
+		c = math.cos(self.theta)
+		s = math.sin(self.theta)
+		ox = other.x
+		oy = self.mirror * other.y  # the mirror flips the y axis before rotating
+		return Pose(self.x + c * ox - s * oy,
+					self.y + s * ox + c * oy,
+					self.theta + self.mirror * other.theta,
+					self.mirror * other.mirror)
+
+	def inverse(self):
+		"""returns the pose that undoes this one, so p.compose(p.inverse()) is the identity"""
+		c = math.cos(self.theta)
+		s = math.sin(self.theta)
+		ux = c * self.x + s * self.y  # rotate the translation back
+		uy = -s * self.x + c * self.y
+		return Pose(-ux, -self.mirror * uy, -self.mirror * self.theta, self.mirror)
+
+	def copy(self):
+		return Pose(self.x, self.y, self.theta, self.mirror)
+
+	def to_matrix(self):
+		"""3x3 homogeneous matrix of the pose"""
+		c = math.cos(self.theta)
+		s = math.sin(self.theta)
+		m = self.mirror
+		return np.array([[c, -s * m, self.x], [s, c * m, self.y], [0, 0, 1]])
+
+
+# --- Testing Code after this point --------------------------------------------------------------------------------
+
+def random_pose(mirror=1):
+	return Pose(np.random.uniform(-500, 500), np.random.uniform(-500, 500), np.random.uniform(-10, 10), mirror)
+
+
+def test_compose(num_tests=1000):
+	for i in range(num_tests):
+		p1 = random_pose(np.random.choice([1, -1]))
+		p2 = random_pose(np.random.choice([1, -1]))
+		assert np.allclose(p1.compose(p2).to_matrix(), p1.to_matrix() @ p2.to_matrix()), "compose doesn't match matrices"
+		assert np.allclose(p1.compose(p1.inverse()).to_matrix(), np.identity(3)), "inverse doesn't undo the pose"
+		assert np.allclose(p1.inverse().compose(p1).to_matrix(), np.identity(3)), "inverse doesn't undo the pose"
+
+
+def test_canvas():
+	"""the old MAP_TO_CANVAS matrix and its pose must put a bug's parts in the same place"""
+	height = 800
+	map_to_canvas = np.array([[1, 0, 0, 0], [0, -1, 0, height], [0, 0, -1, 0], [0, 0, 0, 1]])
+	canvas = Pose(0, height, 0, -1)
+	for i in range(100):
+		bug = random_pose()
+		eye = random_pose()
+		old = map_to_canvas @ to_4x4(bug) @ to_4x4(eye)
+		new = canvas.compose(bug).compose(eye)
+		assert np.isclose(old[0][3], new.x) and np.isclose(old[1][3], new.y), "canvas position moved"
+		assert np.allclose(old[:2, 0], [math.cos(new.theta), math.sin(new.theta)]), "canvas heading changed"
+
+
+def to_4x4(pose):
+	T = np.identity(4)
+	T[:2, :2] = pose.to_matrix()[:2, :2]
+	T[:2, 3] = pose.x, pose.y
+	T[2][2] = pose.mirror  # a mirror in y flips z as well to keep it a rotation, like MAP_TO_CANVAS
+	return T
+
+
+def benchmark(number=20000):
+	"""compares building a transform, and a bug's transforms for one step (build the move, apply it, then place
+		the body, both eyes and their hit boxes), with poses and with the old transforms3d 4x4 matrices"""
+	try:
+		import transforms3d.affines as AFF
+		import transforms3d.euler as E
+	except ImportError:
+		print("transforms3d not installed, can't compare to the 4x4 matrices")
+		return
+
+	def get_pos_transform(x=0, y=0, z=0, theta=0):  # the old BugWorld.get_pos_transform
+		return AFF.compose([x, y, z], E.euler2mat(0, 0, theta), [1, 1, 1])
+
+	canvas_4x4 = [[1, 0, 0, 0], [0, -1, 0, 800], [0, 0, -1, 0], [0, 0, 0, 1]]
+	bug_4x4 = get_pos_transform(100, 200, 0, 0.5)
+	part_4x4 = get_pos_transform(10, 0, 0, 0.5)
+
+	def step_with_matrices():
+		rel = np.matmul(bug_4x4, get_pos_transform(1.0, 0.1, 0, 0.01))
+		body = np.matmul(canvas_4x4, rel)
+		positions = [(body[0][3], body[1][3])]
+		for eye in range(2):
+			hitbox = np.matmul(np.matmul(body, part_4x4), part_4x4)
+			positions.append((hitbox[0][3], hitbox[1][3]))
+		return positions
+
+	canvas = Pose(0, 800, 0, -1)
+	bug = Pose(100, 200, 0.5)
+	part = Pose(10, 0, 0.5)
+
+	def step_with_poses():
+		rel = bug.compose(Pose(1.0, 0.1, 0.01))
+		body = canvas.compose(rel)
+		positions = [(body.x, body.y)]
+		for eye in range(2):
+			hitbox = body.compose(part).compose(part)
+			positions.append((hitbox.x, hitbox.y))
+		return positions
+
+	for name, old, new in (("build a transform", lambda: get_pos_transform(1.0, 0.1, 0, 0.01), lambda: Pose(1.0, 0.1, 0.01)),
+						   ("one bug step", step_with_matrices, step_with_poses)):
+		old_time = timeit.timeit(old, number=number) / number * 1e6
+		new_time = timeit.timeit(new, number=number) / number * 1e6
+		print("{}: transforms3d {:.2f} usec, Pose {:.2f} usec, {:.1f}x faster".format(name, old_time, new_time,
+																					   old_time / new_time))
+
+
+if __name__ == "__main__":
+	test_compose()
+	test_canvas()
+	benchmark()
@@ -0,0 +1,81 @@
+import logging
+import numpy as np
+
+'''
+Runs the parts of the world's update at their own rates, e.g., the bugs can think every 3 steps and look every 2
+while they move every step.  The world asks the scheduler each step which parts are due.
+'''
+
+
+class Scheduler:
+	"""decides which parts of the world's update run on a step.  Each one runs every period steps, on the steps where
+		step % period == phase, so expensive ones with the same period can be put on different steps.  Anything
+		without a rate runs every step"""
+
+	def __init__(self, rates=None):
+		"""rates: name -> (period, phase)"""
+		self._rates = {}
+		for name, (period, phase) in (rates or {}).items():
+			self.set_rate(name, period, phase)
+
+	def set_rate(self, name, period, phase=0):
+		if period < 1:
+			logging.error("period must be at least 1 for: " + name)
+			period = 1
+		self._rates[name] = (period, phase % period)
+
+	def period(self, name):
+		return self._rates.get(name, (1, 0))[0]
+
+	def due(self, name, step):
+		"""True if name runs on this step"""
+		period, phase = self._rates.get(name, (1, 0))
+		return step % period == phase
+
+
+# --- Testing Code after this point ---
+
+def test_scheduler():
+	"""each name runs on its own steps, and a world with slower brains keeps the bugs' velocities in between"""
+	scheduler = Scheduler({'brains': (3, 0), 'vision': (2, 1)})
+	assert [step for step in range(9) if scheduler.due('brains', step)] == [0, 3, 6]
+	assert [step for step in range(9) if scheduler.due('vision', step)] == [1, 3, 5, 7]
+	assert all(scheduler.due('physics', step) for step in range(9)), "no rate should run every step"
+	assert scheduler.period('populations') == 1
+
+	from BugWorld import BugWorld  # BugWorld imports this module
+
+	rates, ray_vision = BugWorld.UPDATE_RATES, BugWorld.RAY_VISION
+	BugWorld.UPDATE_RATES = {'brains': (3, 0), 'vision': (2, 1), 'populations': (5, 0)}
+	try:
+		world = BugWorld()
+		bugs = list(world.entities.of_type(*world.valid_population_types))
+		for step in range(9):
+			before = [(bug.vel_r, bug.vel_l) for bug in bugs]
+			world.update()
+			after = [(bug.vel_r, bug.vel_l) for bug in bugs]
+			if step % 3:
+				assert before == after, "bugs shouldn't think between brain steps"
+		assert world.reproduction_countdown == BugWorld.NUM_STEPS_BEFORE_REPRODUCTION - 10, "counted down 2 times 5"
+
+		# brains every step, vision every 2.  The brains must see the last look, not nothing, in between
+		BugWorld.UPDATE_RATES = {'brains': (1, 0), 'vision': (2, 0)}
+		for rays in (True, False):  # both ways of seeing
+			BugWorld.RAY_VISION = rays
+			world = BugWorld()
+			bugs = list(world.entities.of_type(*world.valid_population_types))
+			saw_something = False
+			for step in range(10):
+				before = [bug.bi.inputs[:bug.bi._num_vision_inputs].copy() for bug in bugs]
+				world.update()  # the brains use what is in the rows at the start of the next step
+				after = [bug.bi.inputs[:bug.bi._num_vision_inputs] for bug in bugs]
+				saw_something = saw_something or any(seen.any() for seen in after)
+				if step % 2:
+					assert all(np.array_equal(b, a) for b, a in zip(before, after)), "vision should be held between looks"
+			assert saw_something, "the bugs should have seen something"
+	finally:
+		BugWorld.UPDATE_RATES, BugWorld.RAY_VISION = rates, ray_vision
+
+
+if __name__ == "__main__":
+	test_scheduler()